@@ -48,8 +48,9 @@ def table(data):
     print("Protocol $\\calQ$ & $|Q|$ & $|T|$ & Time (\\si{s}) & & Stages & Time (\\si{s}) & & Termination? & Bound \\\\")
     print("\\midrule")
     
-    for d in data:
-        if d["elapsed"]["tree"] != "timeout":
+    # Results are listed in the order in which jobs finished
+    for d in sorted(data, key=lambda d: d.get("index", 0)):
+        if d["elapsed"]["tree"] not in ["timeout", "error"]:
             name, protocol = load_protocol(d["protocol"])
             states     = len(protocol["states"])
             transitions = len(protocol["transitions"])
@@ -71,7 +72,7 @@ def table(data):
             terminates = "---"
             witness    = "---"
             speed      = "---"
-            duration   = "timeout"
+            duration   = d["elapsed"]["tree"]
             loading    = "---"
 
         print(TEMPLATE.format(name,
@@ -2,9 +2,12 @@
 import argparse
 import json
 import multiprocessing
+import resource
 import sys
 import time
 import os
+from collections import deque
+from multiprocessing.connection import wait
 
 sys.path.append("..")
 sys.path.append("../src/")
@@ -13,14 +16,11 @@ from src.main import execute
 DESCRIPTION = "Benchmarking utility."
 verbose = False
 
-class Timeout(Exception): pass
-
 def log(message):
     if verbose:
-        print(message)
+        print(message, file=sys.stderr)
 
-# timeout is in seconds
-def benchmark_single(protocol, timeout=None):
+def make_args(protocol):
     args = argparse.Namespace()
 
     if len(protocol) > 1:
@@ -32,46 +32,132 @@ def benchmark_single(protocol, timeout=None):
     args.tree        = None
     args.struct      = False
     args.depth       = None
+    args.jobs        = None
     args.nowitness   = False
     args.implication = False
     args.simp_predicates = False
+    args.incremental = False
+    args.no_cache    = True
+    args.partition   = "pairwise"
+    args.startup_profile = False
+    args.backend     = "z3"
+    args.strategy    = "bfs"
+    args.fail_fast   = False
+    args.checkpoint  = None
+    args.checkpoint_interval = 60
+    args.resume      = False
+    args.stream      = None
+    args.label_length = None
+    args.collapse_depth = None
+    args.failed_only = False
     args.abstract    = [os.path.join("/tmp", os.path.basename(protocol[0]))]
 
-    result = {}
-    
-    def run(queue):
-        result = queue.get()
-        result = json.loads(execute(args))
-        queue.put(result)
-
-    queue = multiprocessing.Queue()
-    queue.put(result)
-    process = multiprocessing.Process(target=run, args=(queue,))
-
-    process.start()
-    process.join(timeout)
-
-    if process.is_alive():
-        process.terminate()
-        process.join()
-        result["elapsed"] = {"tree": "timeout"}
-    else:
-        result = queue.get()
-    
-    result["protocol"] = protocol
+    return args
+
+# Peak resident set size in bytes (ru_maxrss is in kilobytes on Linux)
+def peak_rss(usage):
+    return usage.ru_maxrss if sys.platform == "darwin" else \
+           usage.ru_maxrss * 1024
+
+# Executes protocol in the current (child) process, and sends the result
+# together with the resources used by the process and its children
+def run(connection, protocol):
+    result = json.loads(execute(make_args(protocol)))
+    own      = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    result["resources"] = {"cpu": (own.ru_utime + own.ru_stime +
+                                   children.ru_utime + children.ru_stime),
+                           "peak-rss": max(peak_rss(own), peak_rss(children))}
+
+    connection.send(result)
+    connection.close()
+
+class Job:
+    def __init__(self, index, protocol, timeout):
+        self.index    = index
+        self.protocol = protocol
+        self.deadline = None
+        self.start    = None
+        self._timeout = timeout
+
+    def launch(self):
+        self.connection, child = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=run,
+                                               args=(child, self.protocol))
+        self.start   = time.perf_counter()
+
+        if self._timeout is not None:
+            self.deadline = self.start + self._timeout
+
+        self.process.start()
+        child.close()
+
+    def finish(self, timeout=False):
+        if timeout:
+            self.process.terminate()
+            result = {"elapsed": {"tree": "timeout"}}
+        else:
+            try:
+                result = self.connection.recv()
+            except EOFError: # The process crashed
+                result = {"elapsed": {"tree": "error"}}
+
+        self.process.join()
+        self.connection.close()
+
+        result.setdefault("resources", {"cpu": None, "peak-rss": None})
+        result["resources"]["wall"] = time.perf_counter() - self.start
+        result["protocol"] = self.protocol
+        result["index"]    = self.index
+
+        return result
+
+# Runs protocols in up to jobs concurrent processes, each being terminated
+# after timeout seconds; results are yielded as soon as jobs finish
+def run_jobs(protocols, timeout=None, jobs=1):
+    pending = deque(Job(i, p, timeout) for i, p in enumerate(protocols))
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            job = pending.popleft()
+            job.launch()
+            running[job.connection] = job
+
+            log("Started {}.".format(job.protocol[0]))
+
+        deadlines = [job.deadline for job in running.values()
+                     if job.deadline is not None]
+        wait_time = max(0, min(deadlines) - time.perf_counter()) \
+                    if deadlines else None
+
+        for connection in wait(list(running), wait_time):
+            yield running.pop(connection).finish()
+
+        now = time.perf_counter()
+
+        for connection, job in list(running.items()):
+            if job.deadline is not None and now >= job.deadline:
+                del running[connection]
+                yield job.finish(timeout=True)
 
-    return result
+# timeout is in seconds
+def benchmark_single(protocol, timeout=None):
+    return next(run_jobs([protocol], timeout))
 
-def benchmark_all(config):
+def benchmark_all(config, jobs=1):
     protocols = config["protocols"]
     timeout   = config["timeout"]
 
-    print("[")
+    print("[", flush=True)
     
-    for i, p in enumerate(protocols):
+    for i, result in enumerate(run_jobs(protocols, timeout, jobs)):
         sep = "," if i + 1 < len(protocols) else ""
         
-        print(json.dumps(benchmark_single(p, timeout)) + sep)
+        log("Finished {} ({}/{}).".format(result["protocol"][0], i + 1,
+                                         len(protocols)))
+        print(json.dumps(result) + sep, flush=True)
 
     print("]")
 
@@ -82,9 +168,14 @@ if __name__ == "__main__":
                         help=("benchmarks JSON configuration file"))
     parser.add_argument("-v", "--verbose",
                         help="enable verbosity", action="store_true")
+    parser.add_argument("-j", "--jobs", metavar="n", type=int, default=1,
+                        help="number of protocols benchmarked concurrently")
+    parser.add_argument("-t", "--timeout", metavar="seconds", type=float,
+                        default=None,
+                        help="timeout of each protocol (default: from config)")
 
     args  = parser.parse_args()
-    start = time.process_time()
+    start = time.perf_counter()
 
     verbose = args.verbose 
 
@@ -95,8 +186,11 @@ if __name__ == "__main__":
 
     log("Configuration file loaded.")
 
-    results = benchmark_all(config)
-    end     = time.process_time()
+    if args.timeout is not None:
+        config["timeout"] = args.timeout
+
+    results = benchmark_all(config, max(1, args.jobs))
+    end     = time.perf_counter()
     elapsed = end - start
 
     log("Benchmarking took {:.4f} seconds.".format(elapsed))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import glob
+import inspect
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.append("..")
+sys.path.append("../src/")
+import z3
+import abstract
+import formula
+import stage_tree
+import stage_utils
+from abstract import abstract_protocol, protocol_from_abstraction
+from stage_tree import StageTree
+
+DESCRIPTION = "Per-phase benchmarking utility."
+verbose = False
+
+# Timed phases, as (module, function) pairs. Functions are looked up as
+# module globals (or class attributes), so replacing them times all of their
+# calls; times of nested phases are included in the times of enclosing
+# phases. Generators returned by phases are timed whenever they are resumed
+PHASES = [(abstract,    "parse_protocol"),
+          (abstract,    "make_states"),
+          (abstract,    "simplify_states"),
+          (abstract,    "make_transitions"),
+          (abstract,    "make_initial_output_states"),
+          (abstract,    "test_heads"),
+          (stage_tree,  "new_stages"),
+          (stage_utils, "compute_K"),
+          (stage_utils, "compute_K_from_invariants"),
+          (stage_utils, "refine_K"),
+          (stage_utils, "enlarge_stage_components"),
+          (formula.Formula, "solutions"),
+          (stage_tree,  "check_termination_witness"),
+          (stage_tree,  "is_good")]
+
+# Results of phases holding generators, consumed within the phase so that
+# their computation is timed: new_stages returns its children (enumerated
+# lazily) along with whether K was refined
+CONSUME = {"new_stages": lambda result: (None if result[0] is None
+                                         else list(result[0]), result[1])}
+
+def log(message):
+    if verbose:
+        print(message, file=sys.stderr)
+
+def instrument(timings):
+    originals = []
+
+    def timed(name, function):
+        consume = CONSUME.get(name, lambda result: result)
+
+        def resume(generator):
+            while True:
+                start = time.process_time()
+
+                try:
+                    value = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    timings[name]["time"] += time.process_time() - start
+
+                yield value
+
+        def wrapper(*args, **kwargs):
+            start = time.process_time()
+
+            try:
+                result = consume(function(*args, **kwargs))
+            finally:
+                entry = timings.setdefault(name, {"time": 0.0, "calls": 0})
+                entry["time"]  += time.process_time() - start
+                entry["calls"] += 1
+
+            return resume(result) if inspect.isgenerator(result) else result
+
+        return wrapper
+
+    for module, name in PHASES:
+        function = getattr(module, name)
+        originals.append((module, name, function))
+        setattr(module, name, timed(name, function))
+
+    def restore():
+        for module, name, function in originals:
+            setattr(module, name, function)
+
+    return restore
+
+def benchmark_single(filename, use_t_invariants=True):
+    timings = {}
+    restore = instrument(timings)
+
+    try:
+        with open(filename) as in_file:
+            protocol = json.load(in_file)
+
+        start       = time.process_time()
+        abstraction = abstract_protocol(protocol)
+        timings["abstraction"] = {"time": time.process_time() - start,
+                                  "calls": 1}
+
+        start = time.process_time()
+        StageTree(protocol_from_abstraction(abstraction),
+                  check_termination_witness=True,
+                  use_t_invariants=use_t_invariants)
+        timings["tree"] = {"time": time.process_time() - start, "calls": 1}
+    finally:
+        restore()
+
+    return timings
+
+# Keeps the fastest time of each phase over all repetitions
+def benchmark_all(filenames, repeat):
+    results = {}
+
+    for filename in filenames:
+        name = os.path.splitext(os.path.basename(filename))[0]
+
+        for i in range(repeat):
+            log("Benchmarking {} ({}/{})...".format(name, i + 1, repeat))
+            timings = benchmark_single(filename)
+            best    = results.setdefault(name, timings)
+
+            # Lazily timed phases may only be hit in some repetitions
+            for phase in timings:
+                if (phase not in best or
+                    timings[phase]["time"] < best[phase]["time"]):
+                    best[phase] = timings[phase]
+
+    return results
+
+def load_history(filename):
+    try:
+        with open(filename) as in_file:
+            return json.load(in_file)
+    except FileNotFoundError:
+        return []
+
+def run(args):
+    filenames = args.protocols or sorted(glob.glob("../protocols/*.ppp"))
+    history   = load_history(args.history)
+    entry     = {"date":    datetime.datetime.now().isoformat(),
+                 "label":   args.label,
+                 "z3":      z3.get_version_string(),
+                 "python":  platform.python_version(),
+                 "repeat":  args.repeat,
+                 "results": benchmark_all(filenames, args.repeat)}
+
+    history.append(entry)
+
+    with open(args.history, "w") as out_file:
+        json.dump(history, out_file, indent=2)
+
+    print(json.dumps(entry["results"], indent=2))
+
+# Flags phases slower than in the baseline by more than the threshold
+# (relative), ignoring differences below min_time seconds (noise)
+def compare(args):
+    history  = load_history(args.history)
+
+    if len(history) < 2:
+        print("At least two runs are needed for a comparison.")
+        return 0
+
+    baseline = history[args.baseline]
+    current  = history[args.current]
+    regressions = 0
+
+    log("Comparing {} ({}) with {} ({}).".format(
+        current["date"], current["label"], baseline["date"], baseline["label"]))
+
+    for name in sorted(current["results"]):
+        if name not in baseline["results"]:
+            continue
+
+        for phase in sorted(current["results"][name]):
+            if phase not in baseline["results"][name]:
+                continue
+
+            before = baseline["results"][name][phase]["time"]
+            after  = current["results"][name][phase]["time"]
+            ratio  = after / before if before > 0 else float("inf")
+            status = "ok"
+
+            if (after - before > args.min_time and
+                ratio > 1 + args.threshold):
+                status = "REGRESSION"
+                regressions += 1
+            elif (before - after > args.min_time and
+                  ratio < 1 - args.threshold):
+                status = "improvement"
+
+            print("{:24} {:28} {:10.4f} {:10.4f} {:8.2f}x  {}".format(
+                name, phase, before, after, ratio, status))
+
+    print("{} regression(s).".format(regressions))
+
+    return 1 if regressions > 0 else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("-v", "--verbose",
+                        help="enable verbosity", action="store_true")
+    parser.add_argument("--history", metavar="filename", type=str,
+                        default="phases.json",
+                        help="JSON history of benchmark runs")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="benchmark phases")
+    run_parser.add_argument("protocols", metavar="protocol", nargs="*",
+                            type=str,
+                            help="protocol filenames (default: all protocols)")
+    run_parser.add_argument("-r", "--repeat", metavar="n", type=int,
+                            default=1,
+                            help="keep fastest time over n repetitions")
+    run_parser.add_argument("-l", "--label", metavar="label", type=str,
+                            default=None, help="label of the run")
+
+    compare_parser = commands.add_parser("compare",
+                                         help="compare two runs of history")
+    compare_parser.add_argument("-b", "--baseline", metavar="i", type=int,
+                                default=-2,
+                                help="index of baseline run (default: -2)")
+    compare_parser.add_argument("-c", "--current", metavar="i", type=int,
+                                default=-1,
+                                help="index of current run (default: -1)")
+    compare_parser.add_argument("-t", "--threshold", metavar="ratio",
+                                type=float, default=0.2,
+                                help="relative slowdown flagged as regression")
+    compare_parser.add_argument("-m", "--min-time", metavar="seconds",
+                                type=float, default=0.05,
+                                help="ignore differences below this time")
+
+    args    = parser.parse_args()
+    verbose = args.verbose
+
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 cd benchmarks
-python3 main.py podc19.json | tee output.json
+python3 main.py podc19.json -j "$(getconf _NPROCESSORS_ONLN)" | tee output.json
 python3 format.py output.json | tee table.tex
 if ! [ -x "$(command -v pdflatex)" ]; then
     echo "pdflatex not installed, not generating PDF table"
@@ -1,35 +1,132 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import sys
+import hashlib
+import io
 import json
 import re
+import threading
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from z3 import *
+import cache
+import solver_stats
 from protocol import Protocol
 from transition import Transition
 from unordered_pair import upair
 
 VERBOSE = False
 
+# Version of the abstraction, part of the key of cached abstractions
+VERSION = 2
+
 def log(s):
     if VERBOSE:
         print(s)
 
+# Digests of expressions by context and AST id, along with the expressions
+# so that their ids are not reused
+DIGESTS = cache.Memo(2**16)
+
+def digest(e):
+    """
+    Structural digest of z3 expression e, used as key of queries in the
+    cache instead of serializing whole queries. Digests of subexpressions
+    shared by queries (e.g. constraints of states) are memoized.
+    """
+    key   = (id(e.ctx), e.get_id())
+    entry = DIGESTS.get(key)
+
+    if entry is not None:
+        return entry[1]
+
+    if is_quantifier(e):
+        parts = ['exists' if e.is_exists() else 'forall']
+        parts += ['{}:{}'.format(e.var_name(i), e.var_sort(i)) for i in range(e.num_vars())]
+        parts.append(digest(e.body()))
+    elif not is_app(e) or e.num_args() == 0:
+        parts = [e.sexpr(), str(e.sort_kind())]
+    else:
+        parts = [e.decl().name(), str(e.sort_kind())] + [digest(c) for c in e.children()]
+
+    result = hashlib.sha256(' '.join(parts).encode('utf-8')).hexdigest()
+    DIGESTS.put(key, (e, result))
+
+    return result
+
+@solver_stats.solver_entry
 def check_sat(p):
-    s = Solver()
+    if cache.QUERIES is not None:
+        query  = digest(p)
+        result = cache.QUERIES.get(query)
+        if result is not None:
+            solver_stats.record_cached()
+            return result
+    s = Solver(ctx=p.ctx)
     s.add(p)
-    result = s.check()
+    result = solver_stats.check(s)
     if result == sat:
-        return True
+        result = True
     elif result == unsat:
-        return False
+        result = False
     else:
         raise Exception("Unknown sat result")
+    if cache.QUERIES is not None:
+        cache.QUERIES.put(query, result)
+    return result
 
-def non_empty(p, q, pred):
-    predicate = Exists([Int(param) for param in p['parameters']] + [Int('x')], \
+def non_empty_query(p, q, pred):
+    return Exists([Int(param) for param in p['parameters']] + [Int('x')], \
                     And(And(p['states'][q], p['constraints']), pred))
-    return check_sat(predicate)
+
+@solver_stats.solver_entry
+def non_empty(p, q, pred):
+    return check_sat(non_empty_query(p, q, pred))
+
+@solver_stats.solver_entry
+def check_sat_any(predicate_lists, jobs=1):
+    """
+    Decide for each list of predicates whether one of them is satisfiable,
+    stopping at the first satisfiable predicate of each list. With jobs > 1,
+    lists are distributed among threads, each with its own Z3 context (Z3
+    releases the GIL while solving); results are returned in input order.
+    """
+    if jobs <= 1 or len(predicate_lists) <= 1:
+        return [any(check_sat(p) for p in preds) for preds in predicate_lists]
+
+    results = [None] * len(predicate_lists)
+    tasks   = iter(range(len(predicate_lists)))
+    lock    = threading.Lock()
+    context = solver_stats.context() # Threads do not see the caller
+
+    def work():
+        ctx = Context()
+        solver_stats.set_context(context)
+
+        while True:
+            # The context of the predicates is shared among threads
+            with lock:
+                idx = next(tasks, None)
+
+                if idx is None:
+                    return
+
+                preds = [p.translate(ctx) for p in predicate_lists[idx]]
+
+            results[idx] = any(check_sat(p) for p in preds)
+
+    with ThreadPoolExecutor(jobs) as executor:
+        workers = [executor.submit(work)
+                   for _ in range(min(jobs, len(predicate_lists)))]
+
+        for worker in workers:
+            worker.result()
+
+    return results
+
+@solver_stats.solver_entry
+def check_sat_all(predicates, jobs=1):
+    return check_sat_any([[p] for p in predicates], jobs)
 
 def print_table(p, q, states):
     imax=10
@@ -50,6 +147,7 @@ def print_table(p, q, states):
                 print(" ", end=' ')
         print()
 
+@solver_stats.solver_entry
 def apply_recursively(s, tactic):
     """
     Recursively apply tactic on boolean applications in term s
@@ -84,7 +182,7 @@ def apply_recursively(s, tactic):
                 else:
                     new_n = n.decl()(new_args)
                 if is_bool(new_n):
-                    updated_n = tactic(new_n).as_expr()
+                    updated_n = solver_stats.apply(tactic, new_n).as_expr()
                 else:
                     updated_n = new_n
                 cache[n] = updated_n
@@ -92,6 +190,7 @@ def apply_recursively(s, tactic):
             raise Exception("Quantifiers not supported")
     return cache[s]
 
+@solver_stats.solver_entry
 def simplify_term(s):
     simp = Tactic('simplify')
     qetactic = Tactic('qe')
@@ -99,7 +198,9 @@ def simplify_term(s):
     propineqs = Tactic('propagate-ineqs')
     t = Then(qetactic, Then(simp, Then(propvalues, simp)))
 
-    return simp(apply_recursively(t(s).as_expr(), propineqs)).as_expr()
+    s = solver_stats.apply(t, s).as_expr()
+
+    return solver_stats.apply(simp, apply_recursively(s, propineqs)).as_expr()
 
 def simplify_by_equal_pred(protocol, q, pred, simp_level):
     ivars = ["x"] + protocol['parameters']
@@ -157,26 +258,21 @@ def parse_protocol(protocol):
     for t in protocol['transitions'].values():
         t['predicate'] = parse_predicate(t['predicate'], transition_decls)
 
-def make_states(protocol):
-
-    # TODO: compute separate set of abstract states for each parameterized state
-    worklist = deque()
-
-    # Compute states from output predicate
-    for q in protocol['states'].keys():
-        for predicate in (protocol['trueStates'][q], protocol['falseStates'][q]):
-            if non_empty(protocol, q, predicate):
-                worklist.append( { 'state': q, 'predicate': predicate } )
+def partition_pairwise(protocol, worklist, jobs=1):
+    """
+    Compute partition of states by comparing each new predicate with every
+    abstract state of the same state, splitting and requeuing predicates.
+    Returns abstract states, number of solver queries, and number of
+    queries saved: both differences are not queried for disjoint pairs.
+    """
+    queries = 0
+    saved   = 0
 
-    # Compute states from transitions
-    for t in protocol['transitions'].values():
-        for idx,q in enumerate(t['pre'] + t['post']):
-            predicate = Exists([Int(i) for i in t_indices], \
-                    And( Int('x') == transition_decls[t_indices[idx]], t['predicate'] ))
-            if non_empty(protocol, q, predicate):
-                worklist.append( { 'state': q, 'predicate': predicate } )
+    def non_empty_counted(q, pred):
+        nonlocal queries
+        queries += 1
+        return non_empty(protocol, q, pred)
 
-    # Compute partition of states
     abstract_states = []
     while worklist:
         a = worklist.popleft()
@@ -189,9 +285,9 @@ def make_states(protocol):
                 diff1 = And(a['predicate'], Not(b['predicate']))
                 diff2 = And(Not(a['predicate']), b['predicate'])
 
-                if non_empty(protocol, q, intersection):
-                    d1 = non_empty(protocol, q, diff1)
-                    d2 = non_empty(protocol, q, diff2)
+                if non_empty_counted(q, intersection):
+                    d1 = non_empty_counted(q, diff1)
+                    d2 = non_empty_counted(q, diff2)
 
                     if not d1 and not d2:
                         # [a] and [b] are the same sets, keep one with smaller predicate
@@ -214,6 +310,8 @@ def make_states(protocol):
                         worklist.append({ 'state': q, 'predicate': intersection })
                         worklist.append({ 'state': q, 'predicate': diff1 })
                         worklist.append({ 'state': q, 'predicate': diff2 })
+                else:
+                    saved += 2
 
             if del_state_b:
                 del abstract_states[idx]
@@ -224,10 +322,105 @@ def make_states(protocol):
             abstract_states.append(a)
 
     # Add missing valid states
+    missing = []
     for q,pred in protocol['states'].items():
         predicate = And([pred] + [Not(a['predicate']) for a in abstract_states if q == a['state']])
-        if non_empty(protocol, q, predicate):
-            abstract_states.append( { "state": q, "predicate": predicate } )
+        missing.append( { "state": q, "predicate": predicate } )
+
+    non_empties = check_sat_all([non_empty_query(protocol, a['state'], a['predicate'])
+                                 for a in missing], jobs)
+    abstract_states.extend(a for a,ne in zip(missing, non_empties) if ne)
+    queries += len(missing)
+
+    return (abstract_states, queries, saved)
+
+def partition_atoms(protocol, worklist, jobs=1):
+    """
+    Compute partition of states into the non-empty atoms (Boolean
+    combinations) of the predicates of each state, with a decision tree
+    of splits: each cell C is split by the next predicate P into C & P
+    and C & !P, unless one of them is empty. Returns abstract states,
+    number of solver queries, and number of queries saved: C & !P is not
+    queried for cells disjoint from P. Savings are not relative to
+    partition_pairwise, which may need fewer queries overall.
+    """
+    queries = 0
+    saved   = 0
+    covered = []
+    missing = []
+
+    for q,pred in protocol['states'].items():
+        # Cells as lists of literals, flagged if included in some predicate
+        cells = [ ([], False) ]
+
+        for a in worklist:
+            if a['state'] != q:
+                continue
+
+            p = a['predicate']
+            intersections = check_sat_all([non_empty_query(protocol, q, And(literals + [p]))
+                                           for literals,_ in cells], jobs)
+            candidates    = [ cell for cell,ne in zip(cells, intersections) if ne ]
+            differences   = check_sat_all([non_empty_query(protocol, q, And(literals + [Not(p)]))
+                                           for literals,_ in candidates], jobs)
+            queries      += len(cells) + len(candidates)
+            saved        += len(cells) - len(candidates)
+
+            # Keep cells disjoint from P, and split the other ones
+            cells = [ cell for cell,ne in zip(cells, intersections) if not ne ]
+            for (literals,is_covered),ne in zip(candidates, differences):
+                if ne:
+                    cells.append( (literals + [p], True) )
+                    cells.append( (literals + [Not(p)], is_covered) )
+                else:
+                    # C included in P
+                    cells.append( (literals if literals else [p], True) )
+
+        for literals,is_covered in cells:
+            if is_covered:
+                covered.append( { 'state': q, 'predicate': And(literals) } )
+            elif literals:
+                # Non-empty, since obtained from a split
+                missing.append( { 'state': q, 'predicate': And(literals) } )
+            else:
+                queries += 1
+                if non_empty(protocol, q, pred):
+                    missing.append( { 'state': q, 'predicate': pred } )
+
+    return (covered + missing, queries, saved)
+
+PARTITIONS = { 'pairwise': partition_pairwise, 'atoms': partition_atoms }
+
+def make_states(protocol, jobs=1, partition='pairwise', stats=None):
+
+    # TODO: compute separate set of abstract states for each parameterized state
+    candidates = []
+
+    # Compute states from output predicate
+    for q in protocol['states'].keys():
+        for predicate in (protocol['trueStates'][q], protocol['falseStates'][q]):
+            candidates.append( { 'state': q, 'predicate': predicate } )
+
+    # Compute states from transitions
+    for t in protocol['transitions'].values():
+        for idx,q in enumerate(t['pre'] + t['post']):
+            predicate = Exists([Int(i) for i in t_indices], \
+                    And( Int('x') == transition_decls[t_indices[idx]], t['predicate'] ))
+            candidates.append( { 'state': q, 'predicate': predicate } )
+
+    non_empties = check_sat_all([non_empty_query(protocol, a['state'], a['predicate'])
+                                 for a in candidates], jobs)
+    worklist    = deque(a for a,ne in zip(candidates, non_empties) if ne)
+
+    # Compute partition of states
+    abstract_states, queries, saved = PARTITIONS[partition](protocol, worklist, jobs)
+    log("Partition of states ({}) computed with {} queries ({} saved by disjointness)".format(
+        partition, queries, saved))
+
+    if stats is not None:
+        stats['partition'] = partition
+        stats['partition-queries'] = queries
+        stats['partition-saved'] = saved
 
     return abstract_states
 
@@ -246,35 +439,56 @@ def simplify_states(protocol, states, simp_level):
 def rename_t_var(predicate, index):
     return substitute(predicate, [(Int('x'), transition_decls[t_indices[index]])])
 
-def make_transitions(protocol, states):
-    transitions = set()
+def make_transitions(protocol, states, jobs=1):
+
+    # Index concrete transitions by their concrete pre and post states
+    by_states = {}
+    for t in protocol['transitions'].values():
+        key = (t['pre'][0], t['pre'][1], t['post'][0], t['post'][1])
+        by_states.setdefault(key, []).append(t)
 
+    # Index abstract states by the concrete state they refine
+    refining = {}
     for i,a in enumerate(states):
-        for j,b in enumerate(states):
-            for k,c in enumerate(states):
-                for l,d in enumerate(states):
-                    #if not ((i == k and j == l) or (i == l and j == k)):
-                        for t in protocol['transitions'].values():
-                            if (t['pre'][0] == a['state'] and t['pre'][1] == b['state'] and \
-                                t['post'][0] == c['state'] and t['post'][1] == d['state']):
-                                predicate = Exists([Int(param) for param in protocol['parameters']] + [Int(i) for i in t_indices], \
-                                    And([protocol['constraints'], \
-                                            rename_t_var(protocol['states'][a['state']], 0), \
-                                            rename_t_var(protocol['states'][b['state']], 1), \
-                                            rename_t_var(protocol['states'][c['state']], 2), \
-                                            rename_t_var(protocol['states'][d['state']], 3), \
-                                            rename_t_var(a['predicate'], 0), \
-                                            rename_t_var(b['predicate'], 1), \
-                                            rename_t_var(c['predicate'], 2), \
-                                            rename_t_var(d['predicate'], 3), \
-                                            t['predicate']]))
-                                if check_sat(predicate):
-                                    ip = i if i < j else j
-                                    jp = j if i < j else i
-                                    kp = k if k < l else l
-                                    lp = l if k < l else k
-                                    transitions.add((ip,jp,kp,lp))
-                                    break
+        refining.setdefault(a['state'], []).append(i)
+
+    # Rename predicates once per abstract state (resp. concrete state) and index
+    renamed = [ [ rename_t_var(a['predicate'], idx) for a in states ] \
+                    for idx in range(4) ]
+    renamed_states = [ { q: rename_t_var(pred, idx) \
+                            for q,pred in protocol['states'].items() } \
+                                for idx in range(4) ]
+    variables = [Int(param) for param in protocol['parameters']] + [Int(i) for i in t_indices]
+
+    # Group predicates by abstract transition, which exists if one is satisfiable
+    candidates = {}
+
+    for (qa, qb, qc, qd), trans in by_states.items():
+        for i in refining.get(qa, []):
+            for j in refining.get(qb, []):
+                for k in refining.get(qc, []):
+                    for l in refining.get(qd, []):
+                        ip = i if i < j else j
+                        jp = j if i < j else i
+                        kp = k if k < l else l
+                        lp = l if k < l else k
+
+                        for t in trans:
+                            predicate = Exists(variables, \
+                                And([protocol['constraints'], \
+                                        renamed_states[0][qa], \
+                                        renamed_states[1][qb], \
+                                        renamed_states[2][qc], \
+                                        renamed_states[3][qd], \
+                                        renamed[0][i], \
+                                        renamed[1][j], \
+                                        renamed[2][k], \
+                                        renamed[3][l], \
+                                        t['predicate']]))
+                            candidates.setdefault((ip,jp,kp,lp), []).append(predicate)
+
+    exists      = check_sat_any(list(candidates.values()), jobs)
+    transitions = {t for t,e in zip(candidates.keys(), exists) if e}
 
     for i,j,k,l in transitions:
         a = states[i]
@@ -328,19 +542,16 @@ def pretty_print_pred(pred):
         # pretty quantifiers not supported
         return str(pred)
 
-def make_initial_output_states(protocol, states):
-    initial_states = set()
-    true_states = set()
-    false_states = set()
+def make_initial_output_states(protocol, states, jobs=1):
+    kinds   = ['initialStates', 'trueStates', 'falseStates']
+    queries = [non_empty_query(protocol, a['state'], And(a['predicate'], protocol[kind][a['state']])) \
+                    for a in states for kind in kinds]
+    results = check_sat_all(queries, jobs)
+
+    initial_states = {i for i in range(len(states)) if results[3*i]}
+    true_states    = {i for i in range(len(states)) if results[3*i+1]}
+    false_states   = {i for i in range(len(states)) if results[3*i+2]}
 
-    for i,a in enumerate(states):
-        q = a['state']
-        if non_empty(protocol, q, And(a['predicate'], protocol['initialStates'][q])):
-            initial_states.add(i)
-        if non_empty(protocol, q, And(a['predicate'], protocol['trueStates'][q])):
-            true_states.add(i)
-        if non_empty(protocol, q, And(a['predicate'], protocol['falseStates'][q])):
-            false_states.add(i)
     for i in initial_states:
         log("Initial state {}".format(abstract_state_name(states[i], i)))
     for i in true_states:
@@ -377,11 +588,13 @@ def print_abstract_protocol(out, name, param, states, transitions, initial_state
     out.write('  "title": "{}"\n'.format(name))
     out.write('}\n')
 
-def test_heads(protocol, states, transitions):
+def test_heads(protocol, states, transitions, jobs=1):
     heads = set()
     problematic_heads = set()
     for i,j,k,l in transitions:
         heads.add((i,j))
+    heads = sorted(heads)
+    predicates = []
     for i,j in heads:
         a = states[i]
         b = states[j]
@@ -406,7 +619,11 @@ def test_heads(protocol, states, transitions):
                             rename_t_var(b['predicate'], 1), \
                             ForAll([Int(i) for i in t_indices[2:4]], Not(Or(trans))) \
                         ]))
-        if check_sat(predicate):
+        predicates.append(predicate)
+    for (i,j),problematic in zip(heads, check_sat_all(predicates, jobs)):
+        if problematic:
+            a = states[i]
+            b = states[j]
             log("Potentially problematic head ({},{})".format(abstract_state_name(a, i), abstract_state_name(b, j)))
             problematic_heads.add((i,j))
     return problematic_heads
@@ -421,52 +638,79 @@ def sn(s):
     
     return re.sub(r'[^\x00-\x7F]+','_', s)
 
-def load_abstract_protocol(filename, simp_level = 1, output_file=None):
+def abstract_protocol(protocol, simp_level = 1, jobs=1, partition='pairwise'):
+    parse_protocol(protocol)
+
+    stats  = {}
+    states = make_states(protocol, jobs, partition, stats)
+    simplify_states(protocol, states, simp_level)
+
+    transitions = make_transitions(protocol, states, jobs)
+    io_states   = make_initial_output_states(protocol, states, jobs)
+    initial_states, true_states, false_states = io_states
+
+    problematic_heads = test_heads(protocol, states, transitions, jobs)
+
+    out = io.StringIO()
+    print_abstract_protocol(out, protocol['title'],
+                            protocol['constraints'], states,
+                            transitions, initial_states,
+                            true_states, false_states,
+                            problematic_heads)
+
+    def name(i):
+        return sn(abstract_state_name(states[i], i))
+
+    Q1 = {name(i) for i in true_states}
+    Q0 = {name(i) for i in false_states}
+
+    # Abstraction as JSON-serializable data
+    return { 'states':      sorted(name(i) for i, q in enumerate(states)),
+             'transitions': sorted([name(i), name(j), name(k), name(l)]
+                                   for i, j, k, l in transitions),
+             'initial':     sorted(name(i) for i in initial_states),
+             'output':      {**{q: 1 for q in Q1}, **{q: 0 for q in Q0}},
+             'heads':       sorted([name(i), name(j)]
+                                   for i, j in problematic_heads),
+             'abstract':    out.getvalue(),
+             'stats':       stats }
+
+def load_abstract_protocol(filename, simp_level = 1, output_file=None, jobs=1,
+                           cache=None, partition='pairwise', stats=None):
     # Load protocol
     with open(filename) as in_file:
         protocol = json.load(in_file)
 
-    parse_protocol(protocol)
+    abstraction = None
 
-    states = make_states(protocol)
-    simplify_states(protocol, states, simp_level)
+    if cache is not None:
+        key = cache.key({ 'protocol': protocol, 'simp_level': simp_level,
+                          'partition': partition, 'version': VERSION })
+        abstraction = cache.get(key)
 
-    transitions = make_transitions(protocol, states)
-    io_states   = make_initial_output_states(protocol, states)
-    initial_states, true_states, false_states = io_states
+    if abstraction is None:
+        abstraction = abstract_protocol(protocol, simp_level, jobs, partition)
 
-    problematic_heads = test_heads(protocol, states, transitions)
+        if cache is not None:
+            cache.put(key, abstraction)
 
     if output_file is not None:
         with open(output_file, 'w') as out_file:
-            print_abstract_protocol(out_file, protocol['title'],
-                                    protocol['constraints'], states,
-                                    transitions, initial_states,
-                                    true_states, false_states,
-                                    problematic_heads)
+            out_file.write(abstraction['abstract'])
 
-    # Construct Protocol(...)
-    Q = {sn(abstract_state_name(states[i], i)) for i, q in enumerate(states)}
-    T = set()
-    
-    for i, j, k, l in transitions:
-        a = sn(abstract_state_name(states[i], i))
-        b = sn(abstract_state_name(states[j], j))
-        c = sn(abstract_state_name(states[k], k))
-        d = sn(abstract_state_name(states[l], l))
-
-        T.add(Transition((a, b), (c, d)))
+    if stats is not None:
+        stats.update(abstraction['stats'])
 
-    S  = {sn(abstract_state_name(states[i], i)) for i in initial_states}
-    I  = {q: q for q in S}
+    return protocol_from_abstraction(abstraction)
 
-    Q1 = {sn(abstract_state_name(states[i], i)) for i in true_states}
-    Q0 = {sn(abstract_state_name(states[i], i)) for i in false_states}
-    O  = {**{q: 1 for q in Q1}, **{q: 0 for q in Q0}}
-
-    H  = {upair(sn(abstract_state_name(states[i], i)),
-                sn(abstract_state_name(states[j], j)))
-          for i, j in problematic_heads}
+def protocol_from_abstraction(abstraction):
+    # Construct Protocol(...)
+    Q = set(abstraction['states'])
+    T = {Transition((a, b), (c, d)) for a, b, c, d in abstraction['transitions']}
+    S = set(abstraction['initial'])
+    I = {q: q for q in S}
+    O = abstraction['output']
+    H = {upair(a, b) for a, b in abstraction['heads']}
 
     P = Protocol(Q, T, S, I, O, H)
     P.name = lambda: name
@@ -479,10 +723,14 @@ if __name__ == "__main__":
     if n < 3:
         print("Usage:   {} [input] [output] [options]".format(sys.argv[0]))
         print("Options: -sL   Simplification stage L = 0,1,2,3")
+        print("         -jN   Decide queries with N threads")
+        print("         -pE   Partition engine E = pairwise,atoms")
     else:
         input_file  = sys.argv[1]
         output_file = sys.argv[2]
         simp_level  = 0
+        jobs        = 1
+        partition   = 'pairwise'
         
         for option in sys.argv[3:]:
             if option == "-s1":
@@ -491,6 +739,10 @@ if __name__ == "__main__":
                 simp_level = 2
             if option == "-s3":
                 simp_level = 3
+            if option.startswith("-j"):
+                jobs = int(option[2:])
+            if option.startswith("-p"):
+                partition = option[2:]
 
         with open(input_file) as in_file:
             protocol = json.load(in_file)
@@ -498,18 +750,18 @@ if __name__ == "__main__":
             print(protocol)
             print()
             
-            states = make_states(protocol)
+            states = make_states(protocol, jobs, partition)
             simplify_states(protocol, states, simp_level)
             print()
 
-            transitions = make_transitions(protocol, states)
+            transitions = make_transitions(protocol, states, jobs)
             print()
 
-            io_states = make_initial_output_states(protocol, states)
+            io_states = make_initial_output_states(protocol, states, jobs)
             initial_states, true_states, false_states = io_states
             print()
 
-            problematic_heads = test_heads(protocol, states, transitions)
+            problematic_heads = test_heads(protocol, states, transitions, jobs)
             
             with open(output_file, 'w') as out_file:
                 print_abstract_protocol(out_file, protocol['title'],
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# Cache of solver results shared by all solver entry points (None if disabled)
+QUERIES = None
+
+def default_directory():
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+
+    return os.path.join(base, "ppp-verification")
+
+class DiskCache:
+    """
+    Persistent store of JSON values, with one file per entry named by
+    the hash of its key. Once the entries exceed max_size bytes, least
+    recently used entries (by modification time) are evicted.
+    """
+    def __init__(self, directory=None, max_size=64 * 2**20):
+        self._directory = os.path.join(default_directory(), "abstractions") \
+                          if directory is None else directory
+        self._max_size  = max_size
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @staticmethod
+    def key(data):
+        serialized = json.dumps(data, sort_keys=True)
+
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+
+        try:
+            with open(path) as in_file:
+                value = json.load(in_file)
+
+            os.utime(path) # Mark entry as recently used
+        except (OSError, ValueError):
+            return None
+
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self._directory, exist_ok=True)
+
+        # Write to temporary file first so readers never see partial entries
+        path = self._path(key)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+
+        with open(temp, "w") as out_file:
+            json.dump(value, out_file)
+
+        os.replace(temp, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+
+        for name in os.listdir(self._directory):
+            if name.endswith(".json"):
+                try:
+                    stat = os.stat(os.path.join(self._directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                except OSError:
+                    pass
+
+        size = sum(entry[1] for entry in entries)
+
+        for _, entry_size, name in sorted(entries):
+            if size <= self._max_size:
+                break
+
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except OSError:
+                pass
+
+            size -= entry_size
+
+class Memo:
+    """
+    In-memory memo of at most max_entries values, evicting the least
+    recently used ones, with statistics of hits and misses.
+    """
+    def __init__(self, max_entries=2**14):
+        self._max_entries = max_entries
+        self._entries     = OrderedDict()
+        self.clear_stats()
+
+    def clear_stats(self):
+        self._hits      = 0
+        self._misses    = 0
+        self._evictions = 0
+
+    # Returns value memoized for key, or None if unknown
+    def get(self, key):
+        value = self._entries.get(key, None)
+
+        if value is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+            self._entries.move_to_end(key)
+
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def stats(self):
+        lookups = self._hits + self._misses
+
+        return {"hits": self._hits, "misses": self._misses,
+                "hit-rate": self._hits / lookups if lookups > 0 else None,
+                "entries": len(self._entries), "evictions": self._evictions}
+
+    # Adds statistics collected elsewhere (e.g. in a worker process)
+    def merge(self, stats):
+        self._hits      += stats["hits"]
+        self._misses    += stats["misses"]
+        self._evictions += stats["evictions"]
+
+class QueryCache:
+    """
+    Persistent memo of satisfiability results, keyed by the hash of a
+    canonical serialization of the query (e.g. its SMT-LIB sexpr()).
+    Entries are stored as JSON lines in an append-only log, so that runs
+    only append their new entries instead of rewriting the whole log, and
+    concurrent runs do not overwrite each other's entries. The log is
+    loaded on first use, and compacted to the max_entries most recently
+    used entries once it holds twice as many.
+    """
+    def __init__(self, filename=None, max_entries=2**18):
+        self._filename    = os.path.join(default_directory(), "queries.jsonl") \
+                            if filename is None else filename
+        self._max_entries = max_entries
+        self._entries     = None # Loaded on first use
+        self._lines       = 0    # Number of entries in the log
+        self._new         = []   # Entries not appended to the log yet
+        self._truncated   = False
+        self._lock        = threading.Lock()
+        self._hits        = 0
+        self._misses      = 0
+
+    @staticmethod
+    def _key(query):
+        return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+    # Loads the log, ignoring malformed lines (e.g. a truncated last line
+    # of an interrupted run, then terminated by the next append); later
+    # entries of a key win
+    def _load(self):
+        self._entries = OrderedDict()
+
+        try:
+            with open(self._filename) as in_file:
+                for line in in_file:
+                    self._truncated = not line.endswith("\n")
+
+                    try:
+                        key, sat = json.loads(line)
+                    except (ValueError, TypeError):
+                        continue
+
+                    self._entries[key] = sat
+                    self._entries.move_to_end(key)
+                    self._lines += 1
+        except OSError:
+            pass
+
+    # Returns cached satisfiability of query, or None if unknown
+    def get(self, query):
+        key = QueryCache._key(query)
+
+        with self._lock:
+            if self._entries is None:
+                self._load()
+
+            result = self._entries.get(key, None)
+
+            if result is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+
+        return result
+
+    def put(self, query, sat):
+        key = QueryCache._key(query)
+
+        with self._lock:
+            if self._entries is None:
+                self._load()
+
+            if self._entries.get(key, None) != sat:
+                self._new.append((key, sat))
+
+            self._entries[key] = sat
+            self._entries.move_to_end(key)
+
+    def stats(self):
+        return {"hits": self._hits, "misses": self._misses,
+                "entries": 0 if self._entries is None else len(self._entries)}
+
+    # Removes and returns the entries not saved yet, with the statistics of
+    # lookups since the last call, e.g. to merge them into the cache of the
+    # main process from a worker process
+    def take(self):
+        with self._lock:
+            new   = self._new
+            stats = {"hits": self._hits, "misses": self._misses}
+
+            self._new    = []
+            self._hits   = 0
+            self._misses = 0
+
+        return (new, stats)
+
+    # Adds entries and statistics taken from another cache (see take)
+    def merge(self, new, stats):
+        with self._lock:
+            if self._entries is None:
+                self._load()
+
+            for (key, sat) in new:
+                if self._entries.get(key, None) != sat:
+                    self._new.append((key, sat))
+
+                self._entries[key] = sat
+                self._entries.move_to_end(key)
+
+            self._hits   += stats["hits"]
+            self._misses += stats["misses"]
+
+    # Appends new entries to the log in a single write, so that entries of
+    # concurrent runs are not interleaved. Compaction replaces the log
+    # atomically, and may drop entries appended concurrently since it was
+    # loaded, which are then only computed again
+    def save(self):
+        with self._lock:
+            if len(self._new) == 0:
+                return
+
+            new         = self._new
+            self._new   = []
+            self._lines += len(new)
+            compact     = self._lines > 2 * self._max_entries
+
+            if compact:
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+
+                new         = list(self._entries.items())
+                self._lines = len(new)
+
+            # Terminates a truncated last line before appending
+            lines = "\n" if self._truncated and not compact else ""
+            lines += "".join(json.dumps([key, sat]) + "\n"
+                             for (key, sat) in new)
+            self._truncated = False
+
+        os.makedirs(os.path.dirname(self._filename) or ".", exist_ok=True)
+
+        if compact:
+            temp = "{}.{}.tmp".format(self._filename, os.getpid())
+
+            with open(temp, "w") as out_file:
+                out_file.write(lines)
+
+            os.replace(temp, self._filename)
+        else:
+            fd = os.open(self._filename,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+            try:
+                os.write(fd, lines.encode("utf-8"))
+            finally:
+                os.close(fd)
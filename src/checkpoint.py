@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import os
+import pickle
+
+# Version of the checkpoint format, to be increased whenever the saved state
+# of stage trees changes
+VERSION = 2
+
+# Hash identifying protocol, to check that checkpoints are resumed with the
+# protocol they were saved for
+def fingerprint(protocol):
+    data = [sorted(map(str, protocol.states)),
+            sorted(map(str, protocol.transitions)),
+            sorted(map(str, protocol.initial_states)),
+            sorted(map(str, protocol.true_states)),
+            sorted(map(str, protocol.false_states))]
+
+    return hashlib.sha256(repr(data).encode("utf-8")).hexdigest()
+
+# Saves state of the construction of a stage tree of protocol with options,
+# as a compressed pickle
+def save(filename, protocol, options, state):
+    checkpoint = {"version":  VERSION,
+                  "protocol": fingerprint(protocol),
+                  "options":  options,
+                  "state":    state}
+
+    # Write to temporary file first so that a checkpoint is never partial,
+    # even if the process is killed while saving
+    temp = "{}.{}.tmp".format(filename, os.getpid())
+
+    with gzip.open(temp, "wb") as out_file:
+        pickle.dump(checkpoint, out_file, pickle.HIGHEST_PROTOCOL)
+
+    os.replace(temp, filename)
+
+# Returns the state saved in filename, or None if there is no checkpoint.
+# Raises ValueError if the checkpoint cannot be resumed
+def load(filename, protocol, options):
+    try:
+        with gzip.open(filename, "rb") as in_file:
+            checkpoint = pickle.load(in_file)
+    except FileNotFoundError:
+        return None
+
+    if checkpoint.get("version") != VERSION:
+        raise ValueError("Checkpoint {} has version {} instead of {}.".format(
+            filename, checkpoint.get("version"), VERSION))
+    elif checkpoint["protocol"] != fingerprint(protocol):
+        raise ValueError("Checkpoint {} is of another protocol.".format(
+            filename))
+    elif checkpoint["options"] != options:
+        raise ValueError("Checkpoint {} was saved with options {}.".format(
+            filename, checkpoint["options"]))
+
+    return checkpoint["state"]
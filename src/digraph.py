@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+class Digraph:
+    """
+    Directed graph over vertices 0, ..., n-1, stored as adjacency arrays.
+    Graphs can be cleared and reused, e.g. for the transformation graphs
+    of all stages of a protocol.
+    """
+    def __init__(self, n=0):
+        self._successors = [[] for _ in range(n)]
+
+    def __len__(self):
+        return len(self._successors)
+
+    def clear(self, n=None):
+        n = len(self) if n is None else n
+
+        for successors in self._successors[:n]:
+            successors.clear()
+
+        del self._successors[n:]
+        self._successors.extend([] for _ in range(n - len(self)))
+
+    def add_vertex(self):
+        self._successors.append([])
+
+        return len(self) - 1
+
+    def add_edge(self, i, j):
+        self._successors[i].append(j)
+
+    def successors(self, i):
+        return self._successors[i]
+
+    def edges(self):
+        return ((i, j) for i in range(len(self))
+                       for j in self._successors[i])
+
+    def condensation(self):
+        return Condensation(self)
+
+class Condensation:
+    """
+    Strongly connected components of a graph, numbered in reverse
+    topological order, and edges between components. A component is
+    its own predecessor iff the graph has an edge within it, and it is
+    a bottom component iff it has no edge to another component. The
+    condensation does not depend on the graph afterwards.
+    """
+    def __init__(self, graph):
+        self._labels, self._num = Condensation._tarjan(graph)
+        self._successors = [set() for _ in range(self._num)]
+        self._bottom     = [True] * self._num
+
+        for (i, j) in graph.edges():
+            c, d = self._labels[i], self._labels[j]
+
+            self._successors[c].add(d)
+
+            if c != d:
+                self._bottom[c] = False
+
+    # Iterative version of Tarjan's algorithm
+    @staticmethod
+    def _tarjan(graph):
+        n        = len(graph)
+        index    = [-1] * n
+        low      = [0] * n
+        on_stack = [False] * n
+        labels   = [-1] * n
+        stack    = []
+        counter  = 0
+        num      = 0
+
+        for root in range(n):
+            if index[root] != -1:
+                continue
+
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, 0)]
+
+            while work:
+                v, k       = work[-1]
+                successors = graph.successors(v)
+
+                if k < len(successors):
+                    work[-1] = (v, k + 1)
+                    w        = successors[k]
+
+                    if index[w] == -1:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, 0))
+                    elif on_stack[w]:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+
+                    # v is the root of a component
+                    if low[v] == index[v]:
+                        while True:
+                            w = stack.pop()
+                            on_stack[w] = False
+                            labels[w]   = num
+
+                            if w == v:
+                                break
+
+                        num += 1
+
+        return labels, num
+
+    def __len__(self):
+        return self._num
+
+    # Component of vertex i
+    def component(self, i):
+        return self._labels[i]
+
+    # Checks whether component c has an edge to component d
+    def is_predecessor(self, c, d):
+        return d in self._successors[c]
+
+    def is_bottom(self, c):
+        return self._bottom[c]
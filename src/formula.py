@@ -1,11 +1,34 @@
+import hashlib
+import itertools
 import z3
+import cache
+import sat
+import solver_stats
 from variable import Var
 from valuation import Valuation
 
+# Default mode of new formulas: if True, each formula keeps one incremental
+# solver holding its consistency constraints and assertions, and answers
+# every check within a push/pop scope instead of re-encoding from scratch
+INCREMENTAL = False
+
+# Default backend of new formulas: "z3", "native" (in-process DPLL solver of
+# sat.py, without z3 expressions), or "check", which runs both and raises an
+# exception if their results differ. Assertions are kept as propositional
+# formulas of sat.py over variables (Var) and translated for z3 when needed
+BACKEND  = "z3"
+BACKENDS = ["check", "native", "z3"]
+
 class Formula:
-    def __init__(self):
+    def __init__(self, incremental=None, backend=None):
         self._domain = set()
         self._assertions = []
+        self._incremental = INCREMENTAL if incremental is None else incremental
+        self._backend = BACKEND if backend is None else backend
+        self._solver = None
+        self._serialized = None
+        self._translated = []
+        self._native = None
 
     @property
     def domain(self):
@@ -20,42 +43,61 @@ class Formula:
         return z3.Bool("{}{}".format(var.state,
                                      "!" if var.unique else ""))
 
+    # z3 expression of propositional formula f
+    @staticmethod
+    def _z3(f):
+        if sat.is_atom(f):
+            return Formula._id(f)
+        elif f[0] == "not":
+            return z3.Not(Formula._z3(f[1]))
+        elif f[0] == "and":
+            return z3.And([Formula._z3(g) for g in f[1]])
+        else:
+            return z3.Or([Formula._z3(g) for g in f[1]])
+
+    # z3 expressions of assertions, translated once
+    def _z3_assertions(self):
+        self._translated.extend(Formula._z3(a) for a in
+                                self._assertions[len(self._translated):])
+
+        return self._translated
+
     @staticmethod
     def _states_constraints_and(states, unique_states):
         conjuncts = []
         domain    = set()
 
-        for q in states:
+        for q in sorted(states):
             var = Var(q, unique=unique_states)
             
-            conjuncts.append(z3.Not(Formula._id(var)))
+            conjuncts.append(sat.Not(var))
             domain.add(var)
 
-        return (z3.And(conjuncts), domain)
+        return (sat.And(conjuncts), domain)
 
     @staticmethod
     def _states_constraints_or(states, unique_states):
         conjuncts = []
         domain    = set()
 
-        for q in states:
+        for q in sorted(states):
             var = Var(q, unique=unique_states)
             
-            conjuncts.append(z3.Not(Formula._id(var)))
+            conjuncts.append(sat.Not(var))
             domain.add(var)
 
-        return (z3.Or(conjuncts), domain)
+        return (sat.Or(conjuncts), domain)
             
     def assert_some_states_present(self, states, unique=False):
         constraints, domain = Formula._states_constraints_and(states, unique)
             
-        self._assertions.append(z3.Not(constraints))
+        self._assertions.append(sat.Not(constraints))
         self._domain |= domain
 
     def assert_all_states_present(self, states, unique=False):
         constraints, domain = Formula._states_constraints_or(states, unique)
 
-        self._assertions.append(z3.Not(constraints))
+        self._assertions.append(sat.Not(constraints))
         self._domain |= domain
         
     def assert_some_states_absent(self, states, unique=False):
@@ -75,138 +117,361 @@ class Formula:
         conjuncts = []
         domain    = set()
 
-        for pair in pairs:
-            p, q = tuple(pair)
+        for pair in sorted(pairs, key=sorted):
+            p, q = sorted(pair)
 
             if p != q:
                 domain |= {Var(p), Var(q)}
-                conjuncts.append(z3.Or(z3.Not(Formula._id(Var(p))),
-                                       z3.Not(Formula._id(Var(q)))))
+                conjuncts.append(sat.Or([sat.Not(Var(p)), sat.Not(Var(q))]))
             else:
                 domain |= {Var(p), Var(p, True)}
-                conjuncts.append(z3.Or(z3.Not(Formula._id(Var(p))),
-                                              Formula._id(Var(p, True))))
+                conjuncts.append(sat.Or([sat.Not(Var(p)), Var(p, True)]))
                       
         return (conjuncts, domain)
 
+    @staticmethod
+    def _var_consistency(v):
+        if (v.unique):
+            return sat.Implies(v, v.opposite())
+        else:
+            return sat.Implies(sat.Not(v), sat.Not(v.opposite()))
+
+    # Constraints (as other ones) are generated in a canonical order, so that
+    # identical formulas are serialized identically across runs
     def _consistency_constraints(self):
-        conjuncts = []
-        
-        for v in self._domain:
-            if (v.unique):
-                expr = z3.Implies(Formula._id(v),
-                                  Formula._id(v.opposite()))
-            else:
-                expr = z3.Implies(z3.Not(Formula._id(v)),
-                                  z3.Not(Formula._id(v.opposite())))
-
-            conjuncts.append(expr)
-
-        return z3.And(conjuncts)
+        return sat.And([Formula._var_consistency(v)
+                        for v in sorted(self._domain, key=str)])
 
     def assert_all_pairs_absent(self, pairs):
         constraints, domain = Formula._pairs_constraints(pairs)
 
-        self._assertions.append(z3.And(constraints))
+        self._assertions.append(sat.And(constraints))
         self._domain |= domain
 
     def assert_some_pair_present(self, pairs):
         constraints, domain = Formula._pairs_constraints(pairs)
 
-        self._assertions.append(z3.Not(z3.And(constraints)))
+        self._assertions.append(sat.Not(sat.And(constraints)))
         self._domain |= domain
 
     def assert_some_pair_absent(self, pairs):
         constraints, domain = Formula._pairs_constraints(pairs)
 
-        self._assertions.append(z3.Or(constraints))
+        self._assertions.append(sat.Or(constraints))
         self._domain |= domain
 
     def assert_all_pair_present(self, pairs):
         constraints, domain = Formula._pairs_constraints(pairs)
 
-        self._assertions.append(z3.Not(z3.Or(constraints)))
+        self._assertions.append(sat.Not(sat.Or(constraints)))
         self._domain |= domain
 
+    def _base_solver(self):
+        if not self._incremental:
+            solver = z3.Solver()
+            solver.add(Formula._z3(self._consistency_constraints()))
+            solver.add(self._z3_assertions())
+
+            return solver
+
+        # Synchronize incremental solver with assertions added since last use
+        if self._solver is None:
+            self._solver        = z3.Solver()
+            self._solver_domain = set()
+            self._solver_size   = 0
+
+        for v in sorted(self._domain - self._solver_domain, key=str):
+            self._solver.add(Formula._z3(Formula._var_consistency(v)))
+
+        self._solver.add(self._z3_assertions()[self._solver_size:])
+        self._solver_domain |= self._domain
+        self._solver_size    = len(self._assertions)
+
+        return self._solver
+
+    # Native solver holding consistency constraints and assertions, which
+    # are only encoded again once the formula changed
+    def _native_solver(self):
+        size = (len(self._assertions), len(self._domain))
+
+        if self._native is None or self._native[0] != size:
+            solver = sat.Solver()
+            solver.add(self._consistency_constraints(), *self._assertions)
+            self._native = (size, solver)
+
+        return self._native[1].copy()
+
+    # Digest of the canonical serialization of consistency constraints and
+    # assertions, which are only serialized again once the formula changed
+    def _digest(self):
+        size = (len(self._assertions), len(self._domain))
+
+        if self._serialized is None or self._serialized[0] != size:
+            exprs = [self._consistency_constraints()] + self._assertions
+            data  = "\n".join(sat.sexpr(e) for e in exprs).encode("utf-8")
+            self._serialized = (size, hashlib.sha256(data).hexdigest())
+
+        return self._serialized[1]
+
+    # Key of the query of the formula conjoined with constraints in the
+    # query cache
+    def _query(self, constraints):
+        return "\n".join([self._digest()] +
+                         [sat.sexpr(c) for c in constraints])
+
+    # Checks whether the formula conjoined with constraints is unsatisfiable
+    @solver_stats.solver_entry
+    def _unsat(self, *constraints):
+        if self._backend == "native":
+            return self._native_unsat(constraints)
+
+        unsat = self._z3_unsat(constraints)
+
+        if self._backend == "check" and unsat != self._native_unsat(constraints):
+            raise Exception("Backends disagree on {} with {}".format(
+                self, [sat.sexpr(c) for c in constraints]))
+
+        return unsat
+
+    @solver_stats.solver_entry
+    def _z3_unsat(self, constraints):
+        if cache.QUERIES is not None:
+            query  = self._query(constraints)
+            cached = cache.QUERIES.get(query)
+
+            if cached is not None:
+                solver_stats.record_cached()
+                return not cached
+
+        solver = self._base_solver()
+
+        if self._incremental:
+            solver.push()
+
+        solver.add([Formula._z3(c) for c in constraints])
+        result = solver_stats.check(solver)
+
+        if self._incremental:
+            solver.pop()
+
+        if cache.QUERIES is not None and result != z3.unknown:
+            cache.QUERIES.put(query, result == z3.sat)
+
+        return (result == z3.unsat)
+
+    @solver_stats.solver_entry
+    def _native_unsat(self, constraints):
+        solver = self._native_solver()
+        solver.add(*constraints)
+
+        return (solver_stats.check(solver) == sat.UNSAT)
+
+    # Checks _unsat for each list of constraints of queries. With z3, all
+    # queries are checked on one solver, each one under an assumption
+    # literal guarding its constraints, so that the formula is only encoded
+    # once (the native solver always reuses its encoding)
+    @solver_stats.solver_entry
+    def _unsat_all(self, queries):
+        if self._backend == "native":
+            return [self._native_unsat(constraints) for constraints in queries]
+
+        unsat = self._z3_unsat_all(queries)
+
+        for constraints, result in zip(queries, unsat):
+            if (self._backend == "check" and
+                result != self._native_unsat(constraints)):
+                raise Exception("Backends disagree on {} with {}".format(
+                    self, [sat.sexpr(c) for c in constraints]))
+
+        return unsat
+
+    @solver_stats.solver_entry
+    def _z3_unsat_all(self, queries):
+        results = [None] * len(queries)
+        pending = []
+
+        for i, constraints in enumerate(queries):
+            if cache.QUERIES is not None:
+                query  = self._query(constraints)
+                cached = cache.QUERIES.get(query)
+
+                if cached is not None:
+                    solver_stats.record_cached()
+                    results[i] = not cached
+                    continue
+
+            pending.append((i, query if cache.QUERIES is not None else None))
+
+        if not pending:
+            return results
+
+        solver = self._base_solver()
+
+        if self._incremental:
+            solver.push()
+
+        for i, query in pending:
+            guard = z3.FreshBool("query")
+            solver.add(z3.Implies(guard, z3.And([Formula._z3(c)
+                                                 for c in queries[i]])))
+            result = solver_stats.check(solver, guard)
+
+            if cache.QUERIES is not None and result != z3.unknown:
+                cache.QUERIES.put(query, result == z3.sat)
+
+            results[i] = (result == z3.unsat)
+
+        if self._incremental:
+            solver.pop()
+
+        return results
+
+    @solver_stats.solver_entry
     def implies_all_absent_tautology_check(self, pairs):
-        solver = z3.Solver()
         constraints, _ = Formula._pairs_constraints(pairs)
 
-        solver.add(self._consistency_constraints())
-        solver.add(z3.Not(z3.Implies(z3.And(self._assertions),
-                                     z3.And(constraints))))
+        return self._unsat(sat.Not(sat.And(constraints)))
 
-        result = solver.check()
-        
-        return (result == z3.unsat)
+    # implies_all_absent_tautology_check for each set of pairs, checked on
+    # one solver
+    @solver_stats.solver_entry
+    def implies_all_absent_tautology_checks(self, pair_sets):
+        queries = []
+
+        for pairs in pair_sets:
+            constraints, _ = Formula._pairs_constraints(pairs)
+            queries.append([sat.Not(sat.And(constraints))])
+
+        return self._unsat_all(queries)
 
+    @solver_stats.solver_entry
     def implies_some_present_tautology_check(self, pairs):
-        solver = z3.Solver()
         constraints, _ = Formula._pairs_constraints(pairs)
 
-        solver.add(self._consistency_constraints())
-        solver.add(self._assertions) # (assertions and constraints) equiv. to:
-        solver.add(z3.And(constraints)) # not(assertions => not constraints)
-
-        result = solver.check()
-        
-        return (result == z3.unsat)
+        # (assertions and constraints) equiv. to:
+        # not(assertions => not constraints)
+        return self._unsat(sat.And(constraints))
 
+    @solver_stats.solver_entry
     def implies_all_states_absent_tautology_check(self, states):
-        solver = z3.Solver()
         constraints, _ = Formula._states_constraints_and(states, False)
 
-        solver.add(self._consistency_constraints())
-        solver.add(z3.Not(z3.Implies(z3.And(self._assertions),
-                                     z3.And(constraints))))
+        return self._unsat(sat.Not(constraints))
 
-        result = solver.check()
-        
-        return (result == z3.unsat)
+    # Generator of the valuations of projection (by default, the domain)
+    # that extend to a solution. Each model found is generalized to a cube,
+    # i.e. a partial valuation whose completions are all solutions, which
+    # is blocked as a whole, so that one check yields all of its completions
+    @solver_stats.solver_entry
+    def solutions(self, projection=None):
+        projection = self._domain if projection is None else set(projection)
 
-    def solutions(self):
-        solver = z3.Solver()
-        solver.add(self._consistency_constraints())
-        solver.add(self._assertions)
-        
-        sol = []
+        if self._backend != "check":
+            yield from self._solutions(self._backend, projection)
+            return
+
+        sol = list(self._solutions("z3", projection))
+
+        if set(sol) != set(self._solutions("native", projection)):
+            raise Exception("Backends disagree on solutions of {}".format(self))
 
-        while (solver.check() == z3.sat):
+        yield from sol
+
+    # Drops literals of model (over variables of projection) as long as
+    # formulas remain true under three-valued evaluation
+    @staticmethod
+    def _cube(formulas, model, projection):
+        values = dict(model)
+
+        for var in sorted(projection, key=str):
+            value = values.pop(var)
+
+            if not all(sat.evaluate(f, values) is True for f in formulas):
+                values[var] = value
+
+        return {var: values[var] for var in projection if var in values}
+
+    @solver_stats.solver_entry
+    def _solutions(self, backend, projection):
+        atoms    = self._domain | {v.opposite() for v in self._domain}
+        formulas = [self._consistency_constraints()] + self._assertions
+
+        # Blocking clauses are added to a copy of the solver, so that other
+        # queries on the formula remain correct while solutions are being
+        # enumerated
+        if backend == "native":
+            solver = self._native_solver()
+            found  = sat.SAT
+        else:
+            solver = self._base_solver()
+            found  = z3.sat
+
+            if self._incremental:
+                copy = z3.Solver()
+                copy.add(solver.assertions())
+                solver = copy
+
+        while (solver_stats.check(solver) == found):
             model = solver.model()
-            valuation = Valuation()
 
-            for var in self:
-                valuation[var] = z3.is_true(model[Formula._id(var)])
+            if backend == "native":
+                model = {v: model.get(v, False) for v in atoms}
+            else:
+                model = {v: z3.is_true(model.eval(Formula._id(v),
+                                                  model_completion=True))
+                         for v in atoms}
 
-            sol.append(valuation)
+            cube  = Formula._cube(formulas, model, projection)
+            free  = sorted(projection - cube.keys(), key=str)
 
-            # Forbid solution in future checks
-            solver.add(z3.Or([z3.Not(Formula._id(v)) if valuation[v]
-                              else Formula._id(v) for v in valuation]))
+            # Forbid cube in future checks
+            block = sat.Or([sat.Not(v) if cube[v] else v for v in cube])
+            formulas.append(block)
+            solver.add(block if backend == "native" else Formula._z3(block))
 
-        return sol
+            for values in itertools.product([False, True],
+                                            repeat=len(free)):
+                valuation = Valuation()
 
-    def implies(self, formula):
-        solver = z3.Solver()
+                for var in cube:
+                    valuation[var] = cube[var]
 
-        solver.add(self._consistency_constraints())
-        solver.add(formula._consistency_constraints())
-        solver.add(z3.Not(z3.Implies(z3.And(self._assertions),
-                                     z3.And(formula._assertions))))
+                for var, value in zip(free, values):
+                    valuation[var] = value
 
-        result = solver.check()
-        
-        return (result == z3.unsat)
+                yield valuation
+
+    @solver_stats.solver_entry
+    def implies(self, formula):
+        return self._unsat(formula._consistency_constraints(),
+                           sat.Not(sat.And(formula._assertions)))
+
+    # Structural key: equal for formulas with identical assertions
+    def key(self):
+        return (frozenset(self._domain), tuple(self._assertions))
 
     def make_disjunctive(self):
-        self._assertions = [z3.Or(self._assertions)]
+        self._assertions = [sat.Or(self._assertions)]
+        self._solver     = None
+        self._serialized = None
+        self._translated = []
+        self._native     = None
 
     def assert_formula(self, formula):
         self._domain |= formula._domain
         self._assertions.extend(formula._assertions)
     
+    # z3 solvers and expressions cannot be pickled, and are constructed
+    # again when needed (e.g. in worker processes)
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_solver"]     = None
+        state["_translated"] = []
+
+        return state
+
     def __str__(self):
-        return str(self._assertions)
+        return str([sat.sexpr(a) for a in self._assertions])
                       
     def __repr__(self):
         return str(self)
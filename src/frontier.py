@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import heapq
+from collections import deque
+
+class Frontier:
+    """
+    Stages left to expand, as (index, stage) pairs, removed in the order
+    of an exploration strategy. The peak number of stages held at once is
+    recorded.
+    """
+    def __init__(self):
+        self._peak = 0
+
+    @property
+    def peak(self):
+        return self._peak
+
+    def push(self, index, stage):
+        self._push(index, stage)
+        self._peak = max(self._peak, len(self))
+
+    # Pushes the stages generated by children, as (index, stage) pairs
+    def push_all(self, children):
+        for (index, stage) in children:
+            self.push(index, stage)
+
+    # Restores a frontier from its stages, in the order of iteration, e.g.
+    # when resuming from a checkpoint
+    def restore(self, stages, peak):
+        for (index, stage) in stages:
+            self._push(index, stage)
+
+        self._peak = peak
+
+    # Removes the stages expanded next when jobs stages can be expanded
+    # in parallel
+    def pop_batch(self, jobs):
+        return [self.pop() for _ in range(min(jobs, len(self)))]
+
+class BreadthFirst(Frontier):
+    def __init__(self):
+        super().__init__()
+        self._queue = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def _push(self, index, stage):
+        self._queue.append((index, stage))
+
+    def pop(self):
+        return self._queue.popleft()
+
+    # Whole levels of the tree are expanded in parallel
+    def pop_batch(self, jobs):
+        batch = list(self._queue)
+        self._queue.clear()
+
+        return batch
+
+# Holds, for each level, the next stage and the generator of its following
+# siblings, i.e. at most one stage per level instead of whole levels:
+# siblings are only generated once the stages below the previous ones were
+# expanded
+class DepthFirst(Frontier):
+    def __init__(self):
+        super().__init__()
+        self._stack = [] # [next (index, stage), following (index, stage)]
+
+    def __len__(self):
+        return len(self._stack)
+
+    # Siblings are generated to be iterated over, e.g. to save a checkpoint.
+    # Stages are iterated over in reverse order of removal, as restored
+    def __iter__(self):
+        for entry in self._stack:
+            following = list(entry[1])
+            entry[1]  = iter(following)
+
+            yield from reversed([entry[0]] + following)
+
+    def _push(self, index, stage):
+        self._stack.append([(index, stage), iter(())])
+
+    def push_all(self, children):
+        children = iter(children)
+        first    = next(children, None)
+
+        if first is not None:
+            self._stack.append([first, children])
+            self._peak = max(self._peak, len(self))
+
+    def pop(self):
+        entry = self._stack[-1]
+        first = entry[0]
+        entry[0] = next(entry[1], None)
+
+        if entry[0] is None:
+            self._stack.pop()
+
+        return first
+
+# Expands stages of least cost first, and stages pushed first among them
+class BestFirst(Frontier):
+    def __init__(self, cost):
+        super().__init__()
+        self._heap  = []
+        self._cost  = cost
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        return ((index, stage) for (_, _, index, stage) in sorted(self._heap))
+
+    def _push(self, index, stage):
+        heapq.heappush(self._heap, (self._cost(stage), self._count,
+                                    index, stage))
+        self._count += 1
+
+    def pop(self):
+        _, _, index, stage = heapq.heappop(self._heap)
+
+        return (index, stage)
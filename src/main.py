@@ -1,29 +1,56 @@
 # -*- coding: utf-8 -*-
 import argparse
+import importlib
 import importlib.util
 import json
+import sys
 import time
 
-from abstract import load_abstract_protocol
+import cache
+import solver_stats
+from cache import DiskCache, QueryCache
 from speed import Speed
-from stage_tree import StageTree
-from stage_tree_utils import export
 
 DESCRIPTION = ("Automatic analysis of expected termination time "
                "of population protocols.")
 
 verbose = False
 
+# Engines partitioning states of the abstraction (see abstract.PARTITIONS)
+PARTITIONS = ["atoms", "pairwise"]
+
+# Solvers of stage formulas (see formula.BACKENDS)
+BACKENDS = ["check", "native", "z3"]
+
+# Orders in which stages are expanded (see stage_tree.STRATEGIES)
+STRATEGIES = ["bfs", "dfs", "iddfs", "best"]
+
+# Heavy modules (z3, graph_tool) are only imported once used, and the time
+# taken by each import is recorded
+import_times = {}
+
+def lazy_import(name):
+    if name not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        import_times[name] = time.perf_counter() - start
+
+    return sys.modules[name]
+
 def log(message):
     if verbose:
         print(message)
 
-def load_protocol(filename, args, simp_level = 0, output_file=None):
+def load_protocol(filename, args, simp_level = 0, output_file=None, jobs=1,
+                  cache=None, partition="pairwise", stats=None):
     log("Loading protocol from {}...".format(filename))
     fmt = filename.split(".")[-1]
 
     if fmt == "ppp":
-        protocol = load_abstract_protocol(filename, simp_level, output_file)
+        abstract = lazy_import("abstract")
+        protocol = abstract.load_abstract_protocol(filename, simp_level,
+                                                   output_file, jobs, cache,
+                                                   partition, stats)
     else:
         spec = importlib.util.spec_from_file_location("", filename)
         gen  = importlib.util.module_from_spec(spec)
@@ -37,44 +64,87 @@ def load_protocol(filename, args, simp_level = 0, output_file=None):
     return protocol
 
 def generate_tree(protocol, depth=None, check_termination_witness=False,
-                  use_t_invariants=False):
+                  use_t_invariants=False, jobs=1, strategy="bfs",
+                  fail_fast=False, checkpoint=None, checkpoint_interval=60,
+                  resume=False, stream=None):
     log("Generating stage tree...")
 
+    StageTree = lazy_import("stage_tree").StageTree
     tree = StageTree(protocol, max_depth=depth,
                      check_termination_witness=check_termination_witness,
-                     use_t_invariants=use_t_invariants)
+                     use_t_invariants=use_t_invariants, jobs=jobs,
+                     strategy=strategy, fail_fast=fail_fast,
+                     checkpoint=checkpoint,
+                     checkpoint_interval=checkpoint_interval, resume=resume,
+                     stream=stream)
 
     log("Stage tree generated. ")
-    log(("Generated {} stages "
-         "and {} terminal stages.").format(len(tree.stages),
-                                           len(tree.terminal_stages)))
+    log(("Generated {} stages ({} unique) "
+         "and {} terminal stages ({} unique).").format(
+             tree.total_stages(), len(tree.stages),
+             tree.total_terminal_stages(), len(tree.terminal_stages)))
+    log("At most {} stages were waiting for expansion.".format(
+        tree.peak_frontier))
+
+    failure = tree.failure()
+
+    if failure is not None:
+        log("Expansion stopped at stage {} ({} failed), reached by:".format(
+            failure["stage"], failure["reason"]))
+
+        for stage in failure["path"]:
+            log(" " + stage)
 
     return tree
 
-def export_tree(tree, filename, struct_only):
+def export_tree(tree, filename, struct_only, label_length=None,
+                collapse_depth=None, failed_only=False):
     log("Exporting stage tree...")
-    export(tree, filename=filename, struct_only=struct_only)
+    utils = lazy_import("stage_tree_utils")
+
+    if filename.split(".")[-1] not in utils.RAW_FORMATS:
+        lazy_import("graph_tool")
+
+    utils.export(tree, filename=filename, struct_only=struct_only,
+                 label_length=label_length, collapse_depth=collapse_depth,
+                 failed_only=failed_only)
     log("Stage tree exported to {}.".format(filename))
 
 def execute(args):
     global verbose
     verbose = args.verbose
 
+    lazy_import("z3") # Imported first, so that its time is reported separately
+    formula = lazy_import("formula")
+    formula.INCREMENTAL = args.incremental
+    formula.BACKEND     = args.backend
+    cache.QUERIES = None if args.no_cache else QueryCache()
+
     simp_level = 3 if args.simp_predicates else 1
-    start     = time.process_time()
+    jobs      = 1 if args.jobs is None else args.jobs[0]
+    # Time of worker threads and processes is not accounted separately
+    clock     = time.process_time if jobs <= 1 else time.perf_counter
+    start     = clock()
     prot_args = json.loads(args.protocol[1]) if len(args.protocol) > 1 else []
+    abstractions = None if args.no_cache else DiskCache()
+    abstraction  = {}
     protocol  = load_protocol(args.protocol[0], prot_args,
-                    simp_level, None if args.abstract is None else args.abstract[0])
-    end       = time.process_time()
+                    simp_level, None if args.abstract is None else args.abstract[0],
+                    jobs, abstractions, args.partition, abstraction)
+    end       = clock()
     load_time = end - start
 
     log("Loading took {:.4f} seconds.".format(load_time))
 
     depth     = None if args.depth is None else args.depth[0]
-    start     = time.process_time()
+    checkpoint = None if args.checkpoint is None else args.checkpoint[0]
+    stream    = None if args.stream is None else args.stream[0]
+    start     = clock()
     tree      = generate_tree(protocol, depth, args.nowitness is not True,
-                              args.implication is not True)
-    end       = time.process_time()
+                              args.implication is not True, jobs,
+                              args.strategy, args.fail_fast, checkpoint,
+                              args.checkpoint_interval, args.resume, stream)
+    end       = clock()
     tree_time = end - start
 
     log("Generation took {:.4f} seconds.".format(tree_time))
@@ -101,15 +171,31 @@ def execute(args):
     
     output = {}
     output["elapsed"]  = {"loading": load_time, "tree": tree_time}
-    output["tree"] = {"stages":      len(tree.stages),
-                      "terminal":    len(tree.terminal_stages),
-                      "max-depth":   tree.max_depth(),
-                      "termination": tree.terminates(),
-                      "witness":     tree.witness(),
-                      "speed":       speed}
+    output["abstraction"] = abstraction
+    output["tree"] = {"stages":       len(tree.stages),
+                      "total-stages": tree.total_stages(),
+                      "terminal":     len(tree.terminal_stages),
+                      "total-terminal": tree.total_terminal_stages(),
+                      "max-depth":    tree.max_depth(),
+                      "peak-frontier": tree.peak_frontier,
+                      "termination":  tree.terminates(),
+                      "witness":      tree.witness(),
+                      "speed":        speed,
+                      "failure":      tree.failure()}
+
+    output["solver"] = solver_stats.CALLS
+    output["memo"]   = {"refine_K": tree.refine_stats()}
+
+    if args.startup_profile:
+        output["imports"] = import_times
+
+    if cache.QUERIES is not None:
+        output["cache"] = cache.QUERIES.stats()
+        cache.QUERIES.save()
 
     if args.tree is not None:
-        export_tree(tree, args.tree[0], args.struct)
+        export_tree(tree, args.tree[0], args.struct, args.label_length,
+                    args.collapse_depth, args.failed_only)
 
     return json.dumps(output) if args.out else None
 
@@ -121,14 +207,28 @@ if __name__ == "__main__":
                         help=("protocol filename and "
                                "optional arguments as JSON list"))
     parser.add_argument("-t", "--tree", metavar="filename", nargs=1, type=str,
-                        help="export stage tree to filename")
+                        help=("export stage tree to filename (written "
+                              "directly for .dot and .graphml, drawn with "
+                              "graphviz otherwise)"))
     parser.add_argument("-o", "--out",
                         help="output results", action="store_true")
     parser.add_argument("-v", "--verbose",
                         help="enable verbosity", action="store_true")
+    parser.add_argument("--stream", metavar="filename", nargs=1, type=str,
+                        help=("write stages to filename as JSON lines "
+                              "while they are expanded"))
     parser.add_argument("-s", "--struct",
                         help="generate only stage tree structure (no labels)",
                         action="store_true")
+    parser.add_argument("--label-length", metavar="length", type=int,
+                        help="truncate lines of exported labels to length")
+    parser.add_argument("--collapse-depth", metavar="depth", type=int,
+                        help=("export stages up to depth, summarizing the "
+                              "stages below"))
+    parser.add_argument("--failed-only",
+                        help=("export only stages on paths to stages that "
+                              "failed or have no termination witness"),
+                        action="store_true")
     parser.add_argument("-d", "--depth", metavar="depth", nargs=1, type=int,
                         help="maximum depth of the stage tree")
     parser.add_argument("-w", "--nowitness",
@@ -142,9 +242,60 @@ if __name__ == "__main__":
                         action="store_true")
     parser.add_argument("-a", "--abstract", metavar="filename", nargs=1, type=str,
                         help="export abstract protocol to filename")
+    parser.add_argument("-n", "--incremental",
+                        help="reuse one incremental solver per stage formula",
+                        action="store_true")
+    parser.add_argument("-j", "--jobs", metavar="jobs", nargs=1, type=int,
+                        help=("number of threads computing the abstraction and "
+                              "of processes expanding stages in parallel"))
+    parser.add_argument("--partition", choices=PARTITIONS,
+                        default="pairwise",
+                        help=("engine partitioning states of the abstraction: "
+                              "pairwise comparisons or atoms of predicates"))
+    parser.add_argument("--backend", choices=BACKENDS, default="z3",
+                        help=("solver of stage formulas: z3, native "
+                              "propositional solver, or both with "
+                              "cross-checking of results"))
+    parser.add_argument("--strategy", choices=STRATEGIES, default="bfs",
+                        help=("order in which stages are expanded: "
+                              "breadth-first, depth-first, iterative "
+                              "deepening, or best-first by number of heads "
+                              "not disabled yet"))
+    parser.add_argument("--fail-fast",
+                        help=("stop expanding stages as soon as termination "
+                              "cannot be verified, and report the failing "
+                              "stage"),
+                        action="store_true")
+    parser.add_argument("--checkpoint", metavar="filename", nargs=1,
+                        type=str,
+                        help=("periodically save the construction of the "
+                              "stage tree to filename"))
+    parser.add_argument("--checkpoint-interval", metavar="seconds",
+                        type=float, default=60,
+                        help="minimal time between checkpoints")
+    parser.add_argument("--resume",
+                        help=("resume the construction of the stage tree "
+                              "from the checkpoint file, if it exists"),
+                        action="store_true")
+    parser.add_argument("--no-cache",
+                        help="do not use cached abstractions and solver results",
+                        action="store_true")
+    parser.add_argument("--startup-profile",
+                        help="report time taken by imports of modules",
+                        action="store_true")
 
     args = parser.parse_args()
+
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires --checkpoint")
+
     out  = execute(args)
 
     if out is not None:
         print(out)
+
+    if args.startup_profile:
+        for name in import_times:
+            print("Imported {} in {:.4f} seconds.".format(name,
+                                                          import_times[name]),
+                  file=sys.stderr)
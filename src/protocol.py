@@ -10,6 +10,25 @@ class Protocol:
         self._output      = dict(output_mapping)
         self._problematic_heads = frozenset(problematic_heads)
 
+        # States are numbered once, so that sets of states and of heads
+        # (pairs of states) can be encoded as bitmasks: state i is bit i,
+        # and head {i, j} with i <= j is bit j·(j+1)/2 + i
+        self._index = {q: i for (i, q) in enumerate(sorted(self._states,
+                                                           key=str))}
+        self._head_states = []   # Bitmask of states of each head
+        self._state_heads = [0] * len(self._index) # Heads of each state
+
+        for j in range(len(self._index)):
+            for i in range(j + 1):
+                head = len(self._head_states)
+
+                self._head_states.append((1 << i) | (1 << j))
+                self._state_heads[i] |= 1 << head
+                self._state_heads[j] |= 1 << head
+
+        self._pre_masks = {t: self.states_mask(t.preset)
+                           for t in self._transitions}
+
     @property
     def states(self):
         return self._states
@@ -44,6 +63,61 @@ class Protocol:
     def problematic_heads(self):
         return self._problematic_heads
 
+    # Number of state q
+    def index(self, q):
+        return self._index[q]
+
+    @property
+    def indices(self):
+        return self._index
+
+    def states_mask(self, states):
+        mask = 0
+
+        for q in states:
+            mask |= 1 << self._index[q]
+
+        return mask
+
+    def head_bit(self, head):
+        i, j = sorted(self._index[q] for q in head)
+
+        return j * (j + 1) // 2 + i
+
+    def heads_mask(self, heads):
+        mask = 0
+
+        for head in heads:
+            mask |= 1 << self.head_bit(head)
+
+        return mask
+
+    # Bitmask of the states of the heads of mask
+    def heads_states(self, mask):
+        states = 0
+
+        while mask:
+            low    = mask & -mask
+            states |= self._head_states[low.bit_length() - 1]
+            mask   ^= low
+
+        return states
+
+    # Bitmask of the heads containing a state of mask
+    def states_heads(self, mask):
+        heads = 0
+
+        while mask:
+            low   = mask & -mask
+            heads |= self._state_heads[low.bit_length() - 1]
+            mask  ^= low
+
+        return heads
+
+    # Bitmask of the states of the head of transition t
+    def pre_mask(self, t):
+        return self._pre_masks[t]
+
     def __str__(self):
         return ("Q = {}\n"
                 "T = {}\n"
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Propositional formulas are nested tuples ("not", f), ("and", (f, ...)) and
+# ("or", (f, ...)) over atoms, i.e. any other hashable values (e.g. Var).
+# And(()) is true and Or(()) is false, as in z3
+
+SAT   = "sat"
+UNSAT = "unsat"
+
+def Not(f):
+    return ("not", f)
+
+def And(fs):
+    return ("and", tuple(fs))
+
+def Or(fs):
+    return ("or", tuple(fs))
+
+def Implies(f, g):
+    return ("or", (("not", f), g))
+
+def is_atom(f):
+    return not isinstance(f, tuple)
+
+# Canonical SMT-LIB like serialization of f
+def sexpr(f):
+    if is_atom(f):
+        return "|{}|".format(f)
+    elif f[0] == "not":
+        return "(not {})".format(sexpr(f[1]))
+    else:
+        return "({} {})".format(f[0], " ".join(sexpr(g) for g in f[1]))
+
+# Three-valued evaluation of f under a partial valuation of atoms: True,
+# False, or None if the value of f depends on unassigned atoms
+def evaluate(f, values):
+    if is_atom(f):
+        return values.get(f, None)
+    elif f[0] == "not":
+        value = evaluate(f[1], values)
+
+        return None if value is None else not value
+
+    absorbing = (f[0] == "or") # Value of a subformula deciding f
+    result    = not absorbing
+
+    for g in f[1]:
+        value = evaluate(g, values)
+
+        if value is absorbing:
+            return absorbing
+        elif value is None:
+            result = None
+
+    return result
+
+class Solver:
+    """
+    Small in-process DPLL solver (watched literals, chronological
+    backtracking) for the tiny propositional formulas of stages.
+    Formulas are encoded into clauses over integer variables by the
+    Tseitin transformation; models map atoms to Booleans. Assertions
+    can be scoped by push() and pop(), as in z3.
+    """
+    def __init__(self):
+        self._atoms    = {} # Atom -> variable
+        self._num_vars = 0
+        self._clauses  = []
+        self._formulas = []
+        self._scopes   = []
+        self._model    = None
+
+    def copy(self):
+        other = Solver()
+        other._atoms    = dict(self._atoms)
+        other._num_vars = self._num_vars
+        other._clauses  = list(self._clauses)
+        other._formulas = list(self._formulas)
+        other._scopes   = list(self._scopes)
+
+        return other
+
+    def push(self):
+        self._scopes.append((len(self._atoms), self._num_vars,
+                             len(self._clauses), len(self._formulas)))
+
+    # Removes the assertions (and their variables) since the matching push()
+    def pop(self):
+        atoms, self._num_vars, clauses, formulas = self._scopes.pop()
+
+        for atom in list(self._atoms)[atoms:]:
+            del self._atoms[atom]
+
+        del self._clauses[clauses:]
+        del self._formulas[formulas:]
+
+    def _new_var(self):
+        self._num_vars += 1
+
+        return self._num_vars
+
+    # Literal equivalent to f, adding the clauses defining its subformulas
+    def _literal(self, f):
+        if is_atom(f):
+            if f not in self._atoms:
+                self._atoms[f] = self._new_var()
+
+            return self._atoms[f]
+        elif f[0] == "not":
+            return -self._literal(f[1])
+
+        literals = [self._literal(g) for g in f[1]]
+        x        = self._new_var()
+
+        if f[0] == "and":
+            self._clauses.extend([-x, l] for l in literals)
+            self._clauses.append([x] + [-l for l in literals])
+        else:
+            self._clauses.extend([x, -l] for l in literals)
+            self._clauses.append([-x] + literals)
+
+        return x
+
+    def add(self, *formulas):
+        for f in formulas:
+            # Top-level conjunctions and disjunctions need no definition.
+            # Conjunctions are recorded as their conjuncts
+            if not is_atom(f) and f[0] == "and":
+                self.add(*f[1])
+            elif not is_atom(f) and f[0] == "or":
+                self._formulas.append(f)
+                self._clauses.append([self._literal(g) for g in f[1]])
+            else:
+                self._formulas.append(f)
+                self._clauses.append([self._literal(f)])
+
+    def check(self):
+        values = Solver._solve(self._num_vars, self._clauses)
+
+        if values is None:
+            self._model = None
+
+            return UNSAT
+
+        self._model = {atom: values[x] == 1
+                       for atom, x in self._atoms.items()}
+
+        return SAT
+
+    # Value of each atom in the last model found
+    def model(self):
+        return self._model
+
+    def sexpr(self):
+        return "\n".join(sexpr(f) for f in self._formulas)
+
+    # Returns values (1 or -1) of variables 1, ..., n satisfying clauses,
+    # or None if there are none
+    @staticmethod
+    def _solve(n, clauses):
+        value   = [0] * (n + 1)
+        watches = {}
+        trail   = []
+
+        def val(l):
+            return value[l] if l > 0 else -value[-l]
+
+        def assign(l):
+            if l > 0:
+                value[l] = 1
+            else:
+                value[-l] = -1
+
+            trail.append(l)
+
+        units = []
+
+        for clause in clauses:
+            if len(clause) == 0:
+                return None
+            elif len(clause) == 1:
+                units.append(clause[0])
+            else:
+                clause = list(clause)
+                watches.setdefault(clause[0], []).append(clause)
+                watches.setdefault(clause[1], []).append(clause)
+
+        for l in units:
+            if val(l) == -1:
+                return None
+            elif val(l) == 0:
+                assign(l)
+
+        # Propagates assignments of trail from index head, returns False
+        # on conflict
+        def propagate(head):
+            while head < len(trail):
+                false   = -trail[head]
+                watched = watches.get(false, [])
+                head   += 1
+                i       = 0
+
+                while i < len(watched):
+                    clause = watched[i]
+
+                    if clause[0] == false:
+                        clause[0], clause[1] = clause[1], clause[0]
+
+                    if val(clause[0]) == 1:
+                        i += 1
+                        continue
+
+                    # Look for a new literal to watch
+                    for k in range(2, len(clause)):
+                        if val(clause[k]) != -1:
+                            clause[1], clause[k] = clause[k], clause[1]
+                            watches.setdefault(clause[1], []).append(clause)
+                            watched[i] = watched[-1]
+                            watched.pop()
+                            break
+                    else:
+                        if val(clause[0]) == -1:
+                            return False
+                        elif val(clause[0]) == 0:
+                            assign(clause[0])
+
+                        i += 1
+
+            return True
+
+        if not propagate(0):
+            return None
+
+        decisions = [] # (trail size, literal, whether literal was flipped)
+
+        while True:
+            x = next((x for x in range(1, n + 1) if value[x] == 0), None)
+
+            if x is None:
+                return value
+
+            decisions.append((len(trail), -x, False))
+            assign(-x)
+
+            while not propagate(len(trail) - 1):
+                # Backtrack to last decision not flipped yet
+                while decisions and decisions[-1][2]:
+                    decisions.pop()
+
+                if not decisions:
+                    return None
+
+                size, l, _ = decisions.pop()
+
+                for m in trail[size:]:
+                    value[abs(m)] = 0
+
+                del trail[size:]
+                decisions.append((size, -l, True))
+                assign(-l)
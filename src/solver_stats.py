@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading
+import time
+
+# Statistics of solver calls, by solver entry point and calling function
+CALLS = {}
+
+# Maximal length of the serialization of the slowest query
+QUERY_LENGTH = 1000
+
+_lock    = threading.Lock()
+_local   = threading.local()
+_entries = set() # Code of functions of the solver layer
+
+def solver_entry(function):
+    """
+    Mark function as part of the solver layer: calls are attributed to
+    the outermost such function and to its caller outside of the layer.
+    """
+    _entries.add(function.__code__)
+
+    return function
+
+# Name of the function of code, nested functions being named after the
+# outermost enclosing function
+def _name(code):
+    name = getattr(code, "co_qualname", code.co_name)
+
+    return name.split(".<locals>")[0]
+
+def context():
+    """
+    Returns the solver entry point and the calling function of the
+    caller of context(), or the context set for the current thread.
+    """
+    if getattr(_local, "context", None) is not None:
+        return _local.context
+
+    frame = sys._getframe(1)
+    entry = None
+
+    # Comprehensions and generator expressions are skipped as well
+    while frame is not None and (frame.f_code in _entries or
+                                 frame.f_code.co_name.startswith("<")):
+        if frame.f_code in _entries:
+            entry = _name(frame.f_code)
+
+        frame = frame.f_back
+
+    caller = _name(frame.f_code) if frame is not None else "<module>"
+
+    return (entry or "check", caller)
+
+def set_context(ctx):
+    _local.context = ctx
+
+def record(ctx, result, elapsed, query=None):
+    entry, caller = ctx
+
+    with _lock:
+        calls = CALLS.setdefault(entry, {})
+        stats = calls.setdefault(caller, {"calls": 0, "time": 0.0,
+                                          "sat": 0, "unsat": 0,
+                                          "unknown": 0, "cached": 0,
+                                          "slowest": None})
+        stats["calls"] += 1
+        stats["time"]  += elapsed
+
+        if result is not None:
+            stats[result] += 1
+
+        if result != "cached" and (stats["slowest"] is None or
+                                   elapsed > stats["slowest"]["time"]):
+            serialized = query() if query is not None else None
+
+            if serialized is not None and len(serialized) > QUERY_LENGTH:
+                serialized = serialized[:QUERY_LENGTH] + "..."
+
+            stats["slowest"] = {"time": elapsed, "query": serialized}
+
+# Adds statistics collected elsewhere (e.g. in a worker process)
+def merge(calls):
+    with _lock:
+        for entry in calls:
+            for caller, other in calls[entry].items():
+                stats = CALLS.setdefault(entry, {}).get(caller, None)
+
+                if stats is None:
+                    CALLS[entry][caller] = other
+                    continue
+
+                for field in ["calls", "time", "sat", "unsat", "unknown",
+                              "cached"]:
+                    stats[field] += other[field]
+
+                if (stats["slowest"] is None or
+                    (other["slowest"] is not None and
+                     other["slowest"]["time"] > stats["slowest"]["time"])):
+                    stats["slowest"] = other["slowest"]
+
+@solver_entry
+def check(solver, *assumptions):
+    """
+    Check solver (under assumptions), recording the call under the
+    solver entry point and the calling function.
+    """
+    ctx     = context()
+    start   = time.perf_counter()
+    result  = solver.check(*assumptions)
+    elapsed = time.perf_counter() - start
+
+    record(ctx, str(result), elapsed, solver.sexpr)
+
+    return result
+
+@solver_entry
+def apply(tactic, e):
+    """
+    Apply tactic to expression e, recording the application (which has no
+    sat result) under the solver entry point and the calling function.
+    """
+    ctx     = context()
+    start   = time.perf_counter()
+    result  = tactic(e)
+    elapsed = time.perf_counter() - start
+
+    record(ctx, None, elapsed, e.sexpr)
+
+    return result
+
+@solver_entry
+def record_cached():
+    record(context(), "cached", 0.0)
@@ -12,6 +12,7 @@ class Stage:
         self._formula        = formula
         self._K              = set()
         self._T              = set()
+        self._key            = None # Bitmask encoding (see stage_key)
 
     @property
     def present(self):
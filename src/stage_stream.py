@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import json
+
+# Version of the stream format, to be increased whenever records change
+VERSION = 1
+
+# Stage trees are streamed as JSON lines, one record per line:
+#  {"type": "header", "version": v, "states": [name, ...]}
+#  {"type": "stage", "id": i, "parent": j, "present": [q, ...],
+#   "unique": [...], "absent": [...], "disabled": [[p, q], ...],
+#   "K": [[p, q], ...], "T": [[p, q, r, s], ...], "children": [k, ...],
+#   "flags": [...], "time": seconds}
+#  {"type": "reset"}
+# where states are interned as their position in the header. Stage records
+# are written once stages are expanded, with the identifiers of their
+# children (with multiplicity, as children may be shared). A reset record
+# discards the stages written before, e.g. when the tree is constructed
+# again with iterative deepening, and the last record of a stage wins, e.g.
+# when resuming from a checkpoint expands stages again
+
+class StageWriter:
+    """
+    Writer of the stages of a stage tree of protocol to filename, as they
+    are expanded. The file is appended to if append is True, e.g. when
+    resuming the construction from a checkpoint.
+    """
+    def __init__(self, filename, protocol, append=False):
+        self._file  = open(filename, "a" if append else "w")
+        self._index = protocol.indices
+
+        self._write({"type":    "header",
+                     "version": VERSION,
+                     "states":  [str(q) for q in sorted(self._index,
+                                                        key=self._index.get)]})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")))
+        self._file.write("\n")
+
+    def _states(self, states):
+        return sorted(self._index[q] for q in states)
+
+    def _heads(self, heads):
+        return sorted(sorted(self._index[q] for q in head) for head in heads)
+
+    def reset(self):
+        self._write({"type": "reset"})
+
+    def write(self, index, parent, stage, children, flags, elapsed):
+        transitions = sorted(sorted(self._index[q] for q in t.pre) +
+                             sorted(self._index[q] for q in t.post)
+                             for t in stage._T)
+
+        self._write({"type":     "stage",
+                     "id":       index,
+                     "parent":   parent,
+                     "present":  self._states(stage.present),
+                     "unique":   self._states(stage.present_unique),
+                     "absent":   self._states(stage.absent),
+                     "disabled": self._heads(stage.disabled),
+                     "K":        self._heads(stage._K),
+                     "T":        transitions,
+                     "children": children,
+                     "flags":    flags,
+                     "time":     elapsed})
+
+    def close(self):
+        self._file.close()
+
+# Loads the stages streamed to filename, with states named again. Returns
+# the names of states and a dictionary of stage records by identifier. A
+# truncated last line, e.g. of a killed process, is ignored
+def load(filename):
+    states = []
+    stages = {}
+
+    def names(qs):
+        return {states[q] for q in qs}
+
+    def pairs(heads):
+        return {tuple(states[q] for q in head) for head in heads}
+
+    with open(filename) as in_file:
+        for line in in_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+
+            if record["type"] == "header":
+                if record["version"] != VERSION:
+                    raise ValueError(("Stream {} has version {} "
+                                      "instead of {}.").format(
+                                          filename, record["version"],
+                                          VERSION))
+
+                states = record["states"]
+            elif record["type"] == "reset":
+                stages.clear()
+            else:
+                stages[record["id"]] = {
+                    "parent":   record["parent"],
+                    "present":  names(record["present"]),
+                    "unique":   names(record["unique"]),
+                    "absent":   names(record["absent"]),
+                    "disabled": pairs(record["disabled"]),
+                    "K":        pairs(record["K"]),
+                    "T":        {((states[p], states[q]),
+                                  (states[r], states[s]))
+                                 for p, q, r, s in record["T"]},
+                    "children": record["children"],
+                    "flags":    set(record["flags"]),
+                    "time":     record["time"]}
+
+    return states, stages
@@ -1,58 +1,387 @@
-from graph_tool import Graph
-from graph_tool.topology import shortest_distance
+import multiprocessing
+import time
+from collections import deque
+import cache
+import checkpoint
+import solver_stats
+from cache import Memo
+from digraph import Digraph
 from formula import Formula
+from frontier import BreadthFirst, DepthFirst, BestFirst
 from speed import Speed
 from stage import Stage
-from stage_utils import new_stages, check_termination_witness, is_good
+from stage_stream import StageWriter
+from stage_utils import (new_stages, check_termination_witness, is_good,
+                         stage_key)
+
+# Expands stage, i.e. computes its children and its termination witness.
+# is_good is only evaluated if all expanded stages were good so far
+def expand_stage(protocol, stage, mem, use_t_invariants, check_witness,
+                 all_good):
+    children, refined = new_stages(protocol, stage, mem, use_t_invariants)
+    witness = None
+    good    = None
+
+    if refined and (children is not None) and check_witness:
+        witness = check_termination_witness(protocol, stage, refined)
+
+        if (witness is True) and all_good:
+            good = is_good(protocol, stage, mem, use_t_invariants)
+
+    return (children, refined, witness, good)
+
+# State of a worker process of the expansion pool
+_worker = {}
+
+def _init_worker(protocol, use_t_invariants, check_witness):
+    _worker["protocol"]         = protocol
+    _worker["use_t_invariants"] = use_t_invariants
+    _worker["check_witness"]    = check_witness
+    _worker["mem"]              = {"K": {}, "K_": Memo()}
+
+    # Entries of the query cache inherited from the main process are not
+    # returned to it again
+    if cache.QUERIES is not None:
+        cache.QUERIES.take()
+
+def _expand_in_worker(task):
+    stage, all_good = task
+    solver_stats.CALLS.clear() # Only statistics of this task are returned
+    _worker["mem"]["K_"].clear_stats()
+    start = time.perf_counter()
+    children, refined, witness, good = expand_stage(
+        _worker["protocol"], stage, _worker["mem"],
+        _worker["use_t_invariants"], _worker["check_witness"], all_good)
+
+    # Children are relinked to the parent stage of the main process
+    children = list(children) if children is not None else None
+
+    for child in (children or []):
+        child._parent = None
+
+    # New entries of the query cache are merged into the main process
+    queries = cache.QUERIES.take() if cache.QUERIES is not None else None
+
+    return (children, refined, stage._K, stage._T, witness, good,
+            solver_stats.CALLS, _worker["mem"]["K_"].stats(), queries,
+            time.perf_counter() - start)
+
+# Orders in which stages are expanded: breadth-first, depth-first, iterative
+# deepening (depth-first with increasing depth bounds), and best-first by
+# number of heads not disabled yet
+STRATEGIES = ["bfs", "dfs", "iddfs", "best"]
+
+# Fields of a stage tree saved in checkpoints, besides its frontier and the
+# memoized results of stage_utils
+CHECKPOINT_FIELDS = ["_graph", "_vertices", "_indices", "_children",
+                     "_parents", "_terminal_stages", "_true_stages",
+                     "_false_stages", "_failed_stages", "_all_good",
+                     "_strong_witness", "_failed_witness_stages", "_failure",
+                     "_peak_frontier"]
 
 class StageTree:
     def __init__(self, protocol, max_depth=None,
                  check_termination_witness=False,
-                 use_t_invariants=False):
+                 use_t_invariants=False, jobs=1, strategy="bfs",
+                 fail_fast=False, checkpoint=None, checkpoint_interval=60,
+                 resume=False, stream=None):
         self._protocol  = protocol
-        self._graph     = Graph(directed=True)
-        self._vertices  = {}
         self._max_depth = max_depth
         self._check_termination_witness = check_termination_witness
         self._use_t_invariants = use_t_invariants
+        self._jobs = jobs
+        self._strategy = strategy
+        self._fail_fast = fail_fast
+        self._checkpoint = checkpoint
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_time = time.monotonic()
+        self._resume = resume
+        self._stream = None if stream is None else \
+                       StageWriter(stream, protocol, append=resume)
+        self._peak_frontier = 0
+        self._mem = {"K": {}, "K_": Memo()} # For memoization
+        self._heads = protocol.heads_mask({t.pre for t in protocol.transitions
+                                           if not t.silent()})
+        self._construct_tree()
+
+        if self._stream is not None:
+            self._stream.close()
+
+    def _reset(self):
+        self._graph     = Digraph()
+        self._export_graph = None
+        self._vertices  = {}
+        self._indices   = {} # Index of structurally identical stages
+        self._children  = {}
+        self._parents   = {} # Index of the stage that generated each stage
 
         self._terminal_stages = set()
         self._true_stages     = set()
         self._false_stages    = set()
         self._failed_stages   = set()
-        self._all_good        = check_termination_witness
-        self._strong_witness  = check_termination_witness
+        self._all_good        = self._check_termination_witness
+        self._strong_witness  = self._check_termination_witness
         self._failed_witness_stages = set()
-        self._construct_tree()
+        self._failure = None # First failing stage and reason, if fail-fast
+
+    # Cost of stage for best-first exploration: number of heads of
+    # non-silent transitions that are not disabled yet
+    def _undisabled_heads(self, stage):
+        disabled = stage_key(self.protocol, stage)[3]
+
+        return bin(self._heads & ~disabled).count("1")
+
+    def _new_frontier(self):
+        if self._strategy == "bfs":
+            return BreadthFirst()
+        elif self._strategy == "best":
+            return BestFirst(self._undisabled_heads)
+        else:
+            return DepthFirst()
+
+    # Options that must be the same to resume from a checkpoint
+    def _options(self):
+        return {"max-depth":   self._max_depth,
+                "witness":     self._check_termination_witness,
+                "t-invariant": self._use_t_invariants,
+                "strategy":    self._strategy,
+                "fail-fast":   self._fail_fast}
+
+    # Saves the construction state to the checkpoint file, if enabled and
+    # if the last checkpoint is older than the checkpoint interval (or if
+    # forced)
+    def _save_checkpoint(self, unprocessed, bound, exceeded, force=False):
+        if self._checkpoint is None:
+            return
+
+        now = time.monotonic()
+
+        if (not force and
+            now - self._checkpoint_time < self._checkpoint_interval):
+            return
+
+        state = {name: getattr(self, name) for name in CHECKPOINT_FIELDS}
+        state["mem"]      = {key: self._mem[key] for key in self._mem
+                             if key != "graph"}
+        state["frontier"] = (list(unprocessed), unprocessed.peak)
+        state["bound"]    = bound
+        state["exceeded"] = exceeded
+
+        checkpoint.save(self._checkpoint, self.protocol, self._options(),
+                        state)
+        self._checkpoint_time = time.monotonic()
 
     def _construct_tree(self):
-        def add_vertex(stage):
-            vertex = self._graph.add_vertex()
-            index  = self._graph.vertex_index[vertex]
+        state = None
+
+        if self._resume and self._checkpoint is not None:
+            state = checkpoint.load(self._checkpoint, self.protocol,
+                                    self._options())
+
+        if state is not None:
+            bound = state["bound"]
+        elif self._strategy == "iddfs":
+            bound = 0
+        else:
+            bound = None
+
+        # With iterative deepening, construction is restarted with a larger
+        # depth bound as long as some stage exceeds the bound. Expansions of
+        # stages are kept between rounds (see _cached_expansion), so that
+        # each stage is only expanded once
+        while (self._construct_tree_bounded(bound, state) and
+               self._failure is None):
+            bound += 1
+            state  = None
+
+    @staticmethod
+    def _expansion_key(protocol, stage):
+        return (stage_key(protocol, stage), stage.formula.key())
+
+    # Expansion of stage in a previous round of iterative deepening, with
+    # copies of its children relinked to stage, or None. Expansions are only
+    # recomputed if is_good was not evaluated but would be now
+    def _cached_expansion(self, stage):
+        expansions = self._mem.setdefault("expansions", {})
+        expansion  = expansions.get(StageTree._expansion_key(self.protocol,
+                                                             stage))
+
+        if expansion is None:
+            return None
+
+        children, refined, K, T, witness, good = expansion
+
+        if (good is None) and (witness is True) and self._all_good:
+            return None
+
+        stage._K = K
+        stage._T = T
+
+        if children is not None:
+            children = [Stage(child.present, child.present_unique,
+                              child.absent, child.disabled, child.formula,
+                              stage)
+                        for child in children]
+
+        return (children, refined, witness, good)
+
+    # Records the expansion of stage for the next rounds of iterative
+    # deepening, once all of its children are generated. Returns the
+    # children, to be generated instead of the given ones
+    def _record_expansion(self, stage, children, refined, witness, good):
+        expansions = self._mem.setdefault("expansions", {})
+        key        = StageTree._expansion_key(self.protocol, stage)
+
+        if (children is None) or not refined:
+            expansions[key] = (None, refined, stage._K, stage._T, witness,
+                               good)
+
+            return children
+
+        def record():
+            generated = []
+
+            for child in children:
+                generated.append(child)
+                yield child
+
+            expansions[key] = (generated, refined, stage._K, stage._T,
+                               witness, good)
+
+        return record()
+
+    # Constructs the tree without stages deeper than bound (if not None),
+    # and returns whether stages were left out because of the bound. The
+    # construction continues from state if given, e.g. from a checkpoint
+    def _construct_tree_bounded(self, bound, state=None):
+        # Structurally identical stages are shared. Under a depth bound,
+        # stages are only shared at equal depths, as the children of a stage
+        # reached deeper first could be cut off by the bound
+        def vertex_key(stage):
+            key = (stage_key(self.protocol, stage), stage.formula.key())
+
+            if (self._max_depth is None) and (bound is None):
+                return key
+            else:
+                return key + (stage.depth(),)
+
+        def add_vertex(stage, parent=None):
+            index = self._graph.add_vertex()
 
             self._vertices[index] = stage
+            self._parents[index]  = parent
+            self._indices[vertex_key(stage)] = index
+            self._children[index] = []
 
             return index
 
+        # Edges are added once, but _children keeps their multiplicity
+        # to count the stages of the corresponding tree
         def add_edge(i, j):
-            self._graph.add_edge(i, j)
-
-        phi = Formula()
-        phi.assert_some_states_present(self.protocol.initial_states)
-        
-        root_stage  = Stage(set(), set(), set(), set(), phi)
-        root_index  = add_vertex(root_stage)
-        unprocessed = [(root_index, root_stage)]
-        mem         = {"K": {}, "K_": {}} # For memoization
-        
-        while len(unprocessed) > 0:
-            index, stage = unprocessed.pop(0)
-            children, refined = new_stages(self.protocol, stage, mem, self._use_t_invariants)
+            if j not in self._children[i]:
+                self._graph.add_edge(i, j)
+
+            self._children[i].append(j)
+
+        unprocessed = self._new_frontier()
+        self._reset()
+
+        if state is None:
+            if self._stream is not None:
+                self._stream.reset()
+
+            phi = Formula()
+            phi.assert_some_states_present(self.protocol.initial_states)
+
+            root_stage = Stage(set(), set(), set(), set(), phi)
+            root_index = add_vertex(root_stage)
+            exceeded   = False
+
+            unprocessed.push(root_index, root_stage)
+        else:
+            for name in CHECKPOINT_FIELDS:
+                setattr(self, name, state[name])
+
+            self._mem.update(state["mem"])
+            unprocessed.restore(*state["frontier"])
+            exceeded = state["exceeded"]
+
+        def save(force=False):
+            self._save_checkpoint(unprocessed, bound, exceeded, force)
+
+        # Streams expanded stage, which took elapsed seconds
+        def write(index, stage, elapsed):
+            if self._stream is None:
+                return
+
+            flags = [name for (name, stages) in
+                     [("failed",         self._failed_stages),
+                      ("failed-witness", self._failed_witness_stages),
+                      ("true",           self._true_stages),
+                      ("false",          self._false_stages),
+                      ("terminal",       self._terminal_stages)]
+                     if index in stages]
+
+            self._stream.write(index, self._parents[index], stage,
+                               self._children[index], flags, elapsed)
+
+        # With fail-fast, expansion stops at the first stage failing to be
+        # refined or expanded, as termination cannot be verified anymore.
+        # Stages without termination witness are only flagged, as they do
+        # not affect termination
+        def fail(index, reason):
+            if self._fail_fast and self._failure is None:
+                self._failure = (index, reason)
+
+        # Generates the new children of stage, as (index, stage) pairs, and
+        # adds edges to the shared ones. The stage is streamed once all of
+        # its children are generated, with the time taken to generate them
+        def successors(index, stage, children, elapsed):
+            nonlocal exceeded
 
+            is_terminal = True
+            children    = iter(children)
+
+            while True:
+                start       = time.perf_counter()
+                child_stage = next(children, None)
+                elapsed    += time.perf_counter() - start
+
+                if child_stage is None:
+                    break
+
+                is_terminal = False
+
+                # Add child if depth does not exceed max depth
+                if ((self._max_depth is None) or
+                    (child_stage.depth() <= self._max_depth)):
+                    key = vertex_key(child_stage)
+
+                    # Share structurally identical stages instead of
+                    # expanding them again
+                    if key in self._indices:
+                        add_edge(index, self._indices[key])
+                    elif (bound is not None) and (child_stage.depth() > bound):
+                        exceeded = True
+                    else:
+                        child_index = add_vertex(child_stage, index)
+                        add_edge(index, child_index)
+
+                        yield (child_index, child_stage)
+
+            # If stage is terminal, then flag as terminal
+            if is_terminal:
+                self._terminal_stages.add(index)
+
+            write(index, stage, elapsed)
+
+        def process(index, stage, children, refined, witness, good, elapsed):
             if not refined:
                 # TODO find criterion to continue if refinement fails
                 self._failed_stages.add(index)
-                continue
+                fail(index, "refinement")
+                write(index, stage, elapsed)
+                return
                 #self._strong_witness = False
                 #self._all_good = False
 
@@ -60,18 +389,19 @@ class StageTree:
             # then flag as failure and skip to next iteration
             if children is None:
                 self._failed_stages.add(index)
-                continue
+                fail(index, "expansion")
+                write(index, stage, elapsed)
+                return
 
             # Check termination witness
             if self._check_termination_witness:
-                witness = check_termination_witness(self.protocol, stage, refined)
                 if witness is None:
                     self._failed_witness_stages.add(index)
                 elif witness is False:
                     self._strong_witness = False
                     self._all_good = False
                 elif self._all_good:
-                    self._all_good = is_good(self.protocol, stage, mem, self._use_t_invariants)
+                    self._all_good = good
 
             # If stage in stable consensus, then flag its consensus
             if self.protocol.false_states <= stage.absent:
@@ -79,36 +409,159 @@ class StageTree:
             elif self.protocol.true_states <= stage.absent:
                 self._false_stages.add(index)
 
-            # Construct stage successors
-            is_terminal = True
+            # Construct stage successors (lazily with depth-first
+            # exploration, see frontier.DepthFirst)
+            unprocessed.push_all(successors(index, stage, children, elapsed))
 
-            for child_stage in children:
-                is_terminal = False
+        def expand(stage):
+            result = None if bound is None else self._cached_expansion(stage)
 
-                # Add child if depth does not exceed max depth
-                if ((self._max_depth is None) or
-                    (child_stage.depth() <= self._max_depth)):
-                    child_index = add_vertex(child_stage)
-                    add_edge(index, child_index)
+            if result is not None:
+                return result
 
-                    unprocessed.append((child_index, child_stage))
+            children, refined, witness, good = expand_stage(
+                self.protocol, stage, self._mem, self._use_t_invariants,
+                self._check_termination_witness, self._all_good)
 
-            # If stage is terminal, then flag as terminal
-            if is_terminal:
-                self._terminal_stages.add(index)
+            if bound is not None:
+                children = self._record_expansion(stage, children, refined,
+                                                  witness, good)
+
+            return (children, refined, witness, good)
+
+        if self._jobs <= 1:
+            while len(unprocessed) > 0 and self._failure is None:
+                index, stage = unprocessed.pop()
+                start  = time.perf_counter()
+                result = expand(stage)
+
+                process(index, stage, *result, time.perf_counter() - start)
+                save()
+        else:
+            self._construct_tree_parallel(unprocessed, process, save, bound)
+
+        save(force=True)
+        self._peak_frontier = max(self._peak_frontier, unprocessed.peak)
+
+        return exceeded
+
+    # Expands batches of stages of the frontier in worker processes, and
+    # processes results in frontier order. Batches are whole levels of the
+    # tree for breadth-first exploration, so that the resulting tree is
+    # identical to the one constructed sequentially. With iterative
+    # deepening, stages expanded in previous rounds are not sent to workers
+    def _construct_tree_parallel(self, unprocessed, process, save, bound):
+        context = multiprocessing.get_context("fork")
+        initargs = (self.protocol, self._use_t_invariants,
+                    self._check_termination_witness)
+
+        with context.Pool(self._jobs, _init_worker, initargs) as pool:
+            while len(unprocessed) > 0 and self._failure is None:
+                frontier = unprocessed.pop_batch(self._jobs)
+                cached   = [None if bound is None else
+                            self._cached_expansion(stage)
+                            for (_, stage) in frontier]
+
+                tasks   = [(Stage(stage.present, stage.present_unique,
+                                  stage.absent, stage.disabled,
+                                  stage.formula), self._all_good)
+                           for (_, stage), expansion in zip(frontier, cached)
+                           if expansion is None]
+                results = pool.imap(_expand_in_worker, tasks)
+
+                for (index, stage), expansion in zip(frontier, cached):
+                    if expansion is not None:
+                        process(index, stage, *expansion, 0.0)
+                    else:
+                        (children, refined, K, T, witness, good, calls,
+                         memo, queries, elapsed) = next(results)
+                        start = time.perf_counter()
+                        solver_stats.merge(calls)
+                        self._mem["K_"].merge(memo)
+
+                        if queries is not None:
+                            cache.QUERIES.merge(*queries)
+                        stage._K = K
+                        stage._T = T
+
+                        for child in (children or []):
+                            child._parent = stage
+
+                        if bound is not None:
+                            children = self._record_expansion(
+                                stage, children, refined, witness, good)
+
+                        process(index, stage, children, refined, witness,
+                                good, elapsed + time.perf_counter() - start)
+
+                    if self._failure is not None:
+                        break
+
+                save()
 
     @property
     def protocol(self):
         return self._protocol
 
+    # graph_tool graph of the tree, only constructed (and imported) if needed,
+    # e.g. to export the tree
     @property
     def graph(self):
-        return self._graph
+        if self._export_graph is None:
+            from graph_tool import Graph
+
+            self._export_graph = Graph(directed=True)
+            self._export_graph.add_vertex(len(self._graph))
+            self._export_graph.add_edge_list(list(self._graph.edges()))
+
+        return self._export_graph
+
+    # Statistics of the memo of refine_K (see cache.Memo)
+    def refine_stats(self):
+        return self._mem["K_"].stats()
+
+    # Maximal number of stages waiting to be expanded at once
+    @property
+    def peak_frontier(self):
+        return self._peak_frontier
 
     @property
     def stages(self):
         return self._vertices
 
+    # Number of stages of the tree obtained by unfolding shared stages, among
+    # stages of counted (all if None). Sizes are computed in post-order with
+    # an explicit stack, as trees may be deeper than the recursion limit
+    def _unfolded_size(self, counted=None):
+        sizes = {}
+        stack = [0]
+
+        while stack:
+            i = stack[-1]
+
+            if i in sizes:
+                stack.pop()
+                continue
+
+            pending = [j for j in self._children[i] if j not in sizes]
+
+            if pending:
+                stack.extend(pending)
+            else:
+                stack.pop()
+                sizes[i] = (int(counted is None or i in counted) +
+                            sum(sizes[j] for j in self._children[i]))
+
+        return sizes[0]
+
+    def total_stages(self):
+        return self._unfolded_size()
+
+    # Number of terminal stages of the tree obtained by unfolding shared
+    # stages
+    def total_terminal_stages(self):
+        return self._unfolded_size(self._terminal_stages)
+
     @property
     def terminal_stages(self):
         return self._terminal_stages
@@ -129,12 +582,52 @@ class StageTree:
     def failed_witness_stages(self):
         return self._failed_witness_stages
 
+    # Edges between (indices of) stages, without constructing the graph
+    def edges(self):
+        return self._graph.edges()
+
+    def successors(self, i):
+        return self._graph.successors(i)
+
+    # Distance of each stage from the root
+    def depths(self):
+        distances = {0: 0}
+        queue     = deque([0])
+
+        while queue:
+            i = queue.popleft()
+
+            for j in self._graph.successors(i):
+                if j not in distances:
+                    distances[j] = distances[i] + 1
+                    queue.append(j)
+
+        return distances
+
+    # Maximal distance of a stage from the root
     def max_depth(self):
-        return max(shortest_distance(self._graph,
-                                     source=self._graph.vertex(0)))
+        return max(self.depths().values())
+
+    # First failing stage with fail-fast, with the reason of its failure and
+    # the stages from the root to it, or None
+    def failure(self):
+        if self._failure is None:
+            return None
+
+        index, reason = self._failure
+        path = [index]
+
+        while self._parents[path[-1]] is not None:
+            path.append(self._parents[path[-1]])
+
+        return {"stage":  index,
+                "reason": reason,
+                "path":   [str(self.stages[i]) for i in reversed(path)]}
 
+    # Termination is not verified if expansion was stopped early
     def terminates(self):
-        if self._check_termination_witness and len(self.failed_stages) == 0:
+        if (self._check_termination_witness and
+            len(self.failed_stages) == 0 and self._failure is None):
             return True
         else:
             return None
@@ -1,29 +1,171 @@
 # -*- coding: utf-8 -*-
-from graph_tool.draw import graphviz_draw
+from xml.sax.saxutils import escape
+
+# Formats written directly, without graph_tool and without graph layout
+RAW_FORMATS = ["dot", "graphml"]
 
 def pretty_stage(stage):
     return str(stage)
 
-def export(tree, filename, struct_only=False):
+def stage_color(tree, i):
+    return "gold"         if (i in tree.failed_stages) else \
+           "darkorchid1"  if (i in tree.failed_witness_stages) else \
+           "deepskyblue1" if (i in tree.true_stages)   else \
+           "firebrick2"   if (i in tree.false_stages)  else "azure2"
+
+# Truncates each line of label to at most length characters
+def truncate(label, length=None):
+    if length is None:
+        return label
+
+    return "\n".join(line if len(line) <= length else line[:length] + "…"
+                     for line in label.split("\n"))
+
+# Returns the exported stages: all of them, or only those on paths from the
+# root to (witness-)failed stages if failed_only, up to collapse_depth if not
+# None. Stages at collapse_depth are mapped to the stages below them
+def select(tree, collapse_depth=None, failed_only=False):
+    depths   = tree.depths()
+    selected = set(tree.stages)
+
+    if failed_only:
+        predecessors = {}
+
+        for (i, j) in tree.edges():
+            predecessors.setdefault(j, []).append(i)
+
+        work     = list(tree.failed_stages | tree.failed_witness_stages)
+        selected = set(work)
+
+        while work:
+            for i in predecessors.get(work.pop(), []):
+                if i not in selected:
+                    selected.add(i)
+                    work.append(i)
+
+    collapsed = {}
+
+    if collapse_depth is not None:
+        for i in selected:
+            if depths[i] != collapse_depth:
+                continue
+
+            below = set()
+            work  = [i]
+
+            while work:
+                for j in tree.successors(work.pop()):
+                    if (j in selected and j not in below and
+                        depths[j] > collapse_depth):
+                        below.add(j)
+                        work.append(j)
+
+            if below:
+                collapsed[i] = below
+
+        selected = {i for i in selected if depths[i] <= collapse_depth}
+
+    return selected, collapsed
+
+# Label of stage i, with a summary of the stages collapsed below it
+def stage_label(tree, i, collapsed, label_length=None):
+    label = truncate(pretty_stage(tree.stages[i]), label_length)
+
+    if i in collapsed:
+        below  = collapsed[i]
+        failed = len(below & (tree.failed_stages | tree.failed_witness_stages))
+        label += "\n(+{} stages below, {} failed)".format(len(below), failed)
+
+    return label
+
+def write_dot(tree, out, selected, collapsed, label_length, struct_only):
+    def quote(s):
+        return '"{}"'.format(s.replace("\\", "\\\\").replace('"', '\\"')
+                              .replace("\n", "\\n"))
+
+    out.write("digraph stages {\n")
+    out.write("  node [style=filled];\n")
+
+    for i in sorted(selected):
+        attributes = ["fillcolor={}".format(quote(stage_color(tree, i)))]
+
+        if not struct_only:
+            label = stage_label(tree, i, collapsed, label_length)
+            attributes.append("label={}".format(quote(label)))
+
+        out.write("  {} [{}];\n".format(i, ", ".join(attributes)))
+
+    for (i, j) in tree.edges():
+        if i in selected and j in selected:
+            out.write("  {} -> {};\n".format(i, j))
+
+    out.write("}\n")
+
+def write_graphml(tree, out, selected, collapsed, label_length, struct_only):
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    out.write('  <key id="label" for="node" attr.name="label" '
+              'attr.type="string"/>\n')
+    out.write('  <key id="color" for="node" attr.name="color" '
+              'attr.type="string"/>\n')
+    out.write('  <graph id="stages" edgedefault="directed">\n')
+
+    for i in sorted(selected):
+        out.write('    <node id="{}">\n'.format(i))
+        out.write('      <data key="color">{}</data>\n'.format(
+            stage_color(tree, i)))
+
+        if not struct_only:
+            label = stage_label(tree, i, collapsed, label_length)
+            out.write('      <data key="label">{}</data>\n'.format(
+                escape(label)))
+
+        out.write('    </node>\n')
+
+    for (i, j) in tree.edges():
+        if i in selected and j in selected:
+            out.write('    <edge source="{}" target="{}"/>\n'.format(i, j))
+
+    out.write('  </graph>\n')
+    out.write('</graphml>\n')
+
+# Exports tree to filename: DOT and GraphML files (by extension) are written
+# directly in linear time, other formats are drawn by graphviz (with dot
+# layout) through graph_tool
+def export(tree, filename, struct_only=False, label_length=None,
+           collapse_depth=None, failed_only=False):
+    selected, collapsed = select(tree, collapse_depth, failed_only)
+    fmt = filename.split(".")[-1]
+
+    if fmt in RAW_FORMATS:
+        write = write_dot if fmt == "dot" else write_graphml
+
+        with open(filename, "w", encoding="utf-8") as out_file:
+            write(tree, out_file, selected, collapsed, label_length,
+                  struct_only)
+
+        return
+
+    from graph_tool import GraphView
+    from graph_tool.draw import graphviz_draw
+
     SIZE = (200, 150)
     FONT_SIZE = 40.0
-    
-    labels = tree.graph.new_vertex_property("string")
-    colors = tree.graph.new_vertex_property("string")
-    
-    for i in tree.stages:
-        labels[i] = pretty_stage(tree.stages[i])
-        colors[i] = "gold"         if (i in tree.failed_stages) else \
-                    "darkorchid1"  if (i in tree.failed_witness_stages) else \
-                    "deepskyblue1" if (i in tree.true_stages)   else \
-                    "firebrick2"   if (i in tree.false_stages)  else "azure2"
+
+    graph  = GraphView(tree.graph, vfilt=lambda v: int(v) in selected)
+    labels = graph.new_vertex_property("string")
+    colors = graph.new_vertex_property("string")
+
+    for i in selected:
+        labels[i] = stage_label(tree, i, collapsed, label_length)
+        colors[i] = stage_color(tree, i)
 
     if not struct_only:
-        graphviz_draw(tree.graph, layout="dot",
+        graphviz_draw(graph, layout="dot",
                       vprops={"label": labels, "fillcolor": colors,
                               "fontsize": FONT_SIZE},
                       output=filename, size=SIZE, ratio="auto")
     else:
-        graphviz_draw(tree.graph, layout="dot",
+        graphviz_draw(graph, layout="dot",
                       vprops={"fillcolor": colors},
                       output=filename, size=SIZE, ratio="auto")
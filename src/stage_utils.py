@@ -1,31 +1,92 @@
 import z3
-from graph_tool import Graph
-from graph_tool.topology import label_components
+from collections import deque
+import solver_stats
+from digraph import Digraph
 from formula import Formula
 from stage import Stage
 from unordered_pair import upair
 
-def transformation_graph(protocol, stage):
-    V = set(protocol.states)
-    T = set()
-    graph    = Graph(directed=True)
-    vertices = {v: i for (i, v) in enumerate(V)}
-    edges    = dict()
+# States whose constraints in stage_formula may differ between stage and
+# other, i.e. the states with different presence/absence constraints, the
+# states of heads disabled in only one of them, and the states of disabled
+# heads sharing a state with the former (as bitmask)
+def changed_states(protocol, stage, other):
+    P,  U,  A,  D  = stage_key(protocol, stage)
+    P_, U_, A_, D_ = stage_key(protocol, other)
+
+    changed = (P ^ P_) | (U ^ U_) | (A ^ A_)
+    heads   = (D | D_) & protocol.states_heads(changed)
+
+    return (changed |
+            protocol.heads_states(D ^ D_) |
+            protocol.heads_states(heads))
+
+# Non-silent transitions whose head is not disabled in stage, i.e. not
+# absent in all of its configurations. stage_formula only relates the
+# constraints of states sharing a disabled head, so if mem is given and the
+# parent stage was considered before, only the heads containing a changed
+# state (see changed_states) are checked again, and the others keep their
+# status in the parent stage
+def enabled_transitions(protocol, stage, mem=None):
+    if mem is None:
+        mem = {}
+
+    memo   = mem.setdefault("enabled", {})
+    key    = stage_key(protocol, stage)
+    parent = stage.parent
+
+    if key in memo:
+        return memo[key]
+
+    if parent is not None and stage_key(protocol, parent) in memo:
+        changed   = changed_states(protocol, stage, parent)
+        enabled   = {t for t in memo[stage_key(protocol, parent)]
+                     if not (protocol.pre_mask(t) & changed)}
+        unchecked = {t for t in memo[stage_key(protocol, parent)]
+                     if protocol.pre_mask(t) & changed}
+    else:
+        enabled   = set()
+        unchecked = {t for t in protocol.transitions if not t.silent()}
 
-    def add_edge(p, q, t):
-        graph.add_edge(vertices[p], vertices[q])
+    Phi = stage_formula(stage)
+
+    for t in unchecked:
+        if ((t.pre not in stage.disabled) and
+            (not Phi.implies_all_absent_tautology_check({t.pre}))):
+            enabled.add(t)
+
+    memo[key] = frozenset(enabled)
+
+    return memo[key]
+
+# Returns the transformation graph of stage, whose vertices are the numbers
+# of states. If mem is given, the graph is reused from the previous call,
+# and is only valid until the next call
+def transformation_graph(protocol, stage, mem=None):
+    vertices = protocol.indices
+
+    if mem is not None and "graph" in mem:
+        graph = mem["graph"]
+        graph.clear()
+    else:
+        graph = Digraph(len(vertices))
+
+        if mem is not None:
+            mem["graph"] = graph
 
+    edges = dict()
+
+    def add_edge(p, q, t):
         if (p, q) in edges:
             edges[p, q].add(t)
         else:
+            graph.add_edge(vertices[p], vertices[q])
             edges[p, q] = {t}
 
-    graph.add_vertex(len(V))
-    Phi = stage_formula(stage)
+    enabled = enabled_transitions(protocol, stage, mem)
 
     for t in protocol.transitions:
-        if ((not t.silent()) and
-            (not Phi.implies_all_absent_tautology_check({t.pre}))):
+        if t in enabled:
             if len(t.preset & t.postset) == 0:
                 A, B = t.pre
                 C, D = t.post
@@ -44,19 +105,20 @@ def transformation_graph(protocol, stage):
     return (graph, vertices, edges)
 
 def compute_K(protocol, stage, mem):
-    key = stage_key(stage)
+    key = stage_key(protocol, stage)
 
     if key in mem["K"]:
        return mem["K"][key]
 
-    graph, vertices, edges = transformation_graph(protocol, stage)
-    components, _          = label_components(graph)
+    graph, vertices, edges = transformation_graph(protocol, stage, mem)
+    components             = graph.condensation()
 
     K = set()
     T = set()
 
     for (p, q) in edges:
-        if components[vertices[p]] != components[vertices[q]]:
+        if (components.component(vertices[p]) !=
+            components.component(vertices[q])):
             for t in edges[p, q]:
                 K.add(t.pre)
                 T.add(t)
@@ -66,72 +128,117 @@ def compute_K(protocol, stage, mem):
     return K, T
 
 def refine_K(protocol, stage, K, mem):
+    # The fixed point only depends on stage_formula and on K, so results are
+    # memoized (in a Memo) by both. In particular, results for the different
+    # K of transition invariants and of the implication graph do not clash
+    key    = (stage_key(protocol, stage), protocol.heads_mask(K))
+    result = mem["K_"].get(key)
+
+    if result is not None:
+        return set(result)
+
+    # Transitions that may produce each head of K, with the assertions
+    # added to the formula checking that they stay disabled (states absent
+    # and present, or state uniquely present), and states involved in these
+    # checks
+    support  = {}
+    involved = {}
+
+    for EF in K:
+        support[EF]  = []
+        involved[EF] = set(EF)
+
+        for t in protocol.transitions:
+            # Case AB -> EF
+            if t.post == EF:
+                support[EF].append((t, ()))
+            # Case AB -> EG (and its symmetric case)
+            elif len(t.postset & set(EF)) == 1:
+                E = list(t.postset & set(EF))[0]
+                F = EF.other(E)
+
+                if E != F:
+                    support[EF].append((t, (E, F)))
+                elif E not in t.pre:
+                    support[EF].append((t, (E,)))
+                else:
+                    continue
+            else:
+                continue
 
-    # TODO: fix bug when refine_K is called both for transition invariants
-    # and for implication graph on the same stage, but with different K
-    # maybe use different mems for transition invariant and implication graph?
-    #key = stage_key(stage)
+            involved[EF] |= t.preset
 
-    #if key in mem["K_"]:
-    #    return mem["K_"][key]
+    dependents = {} # Heads of K whose checks involve each state
 
-    def f(X):
-        to_remove = set()
+    for EF in K:
+        for q in involved[EF]:
+            dependents.setdefault(q, []).append(EF)
 
-        for EF in X:
-            r = False
+    Phi      = stage_formula(stage)
+    X        = set(K)
+    formulas = {} # Formulas of the current X, by added assertions
 
-            for t in protocol.transitions:
-                Phi = stage_formula(stage)
-                Phi.assert_all_pairs_absent(X)
+    def formula(extra):
+        if extra not in formulas:
+            Psi = Formula()
+            Psi.assert_formula(Phi)
+            Psi.assert_all_pairs_absent(X)
 
-                # Case AB -> EF
-                if t.post == EF:
-                    r = not Phi.implies_all_absent_tautology_check({t.pre})
-                # Case AB -> EG (and its symmetric case)
-                elif len(t.postset & set(EF)) == 1:
-                    E = list(t.postset & set(EF))[0]
-                    F = EF.other(E)
-                    G = t.post.other(E)
+            if len(extra) == 2:
+                Psi.assert_all_states_absent({extra[0]})
+                Psi.assert_all_states_present({extra[1]})
+            elif len(extra) == 1:
+                Psi.assert_all_states_present({extra[0]}, unique=True)
 
-                    if E != F:
-                        Phi.assert_all_states_absent({E})
-                        Phi.assert_all_states_present({F})
+            formulas[extra] = Psi
 
-                        r = not Phi.implies_all_absent_tautology_check({t.pre})
-                    else:
-                        Phi.assert_all_states_present({E}, unique=True)
+        return formulas[extra]
 
-                        r = not (E in t.pre or
-                            Phi.implies_all_absent_tautology_check({t.pre}))
+    # Checks whether EF must be removed from X, i.e. whether a transition
+    # producing it may be enabled while X is absent
+    def removable(EF):
+        return any(not formula(extra).implies_all_absent_tautology_check(
+                           {t.pre})
+                   for (t, extra) in support[EF])
 
-                if r:
-                    break
+    # Compute greatest fixed-point with a worklist. Heads are only removed
+    # if X is consistent with stage_formula, and then (as in
+    # enabled_transitions) a check only depends on the pairs of X sharing a
+    # state with the heads and states it involves. So removing a head only
+    # requires checking again the heads depending on one of its states
+    work   = deque(K)
+    queued = set(K)
 
-            if r:
-                to_remove.add(EF)
+    while work:
+        EF = work.popleft()
+        queued.discard(EF)
 
-        return set(X) - to_remove
+        if not removable(EF):
+            continue
 
-    # Compute greatest fixed-point of f
-    M  = set(K)
-    M_ = f(M)
+        X.discard(EF)
+        formulas.clear()
+
+        for q in EF:
+            for GH in dependents[q]:
+                if GH in X and GH not in queued:
+                    work.append(GH)
+                    queued.add(GH)
 
-    while M != M_:
-        M  = M_
-        M_ = f(M)
+    mem["K_"].put(key, frozenset(X))
 
-    # TODO readd (see above)
-    #mem["K_"][key] = M
+    return X
 
-    return M
+# Unique key associated with stage_formula: bitmasks of present, uniquely
+# present and absent states, and of disabled heads (see Protocol)
+def stage_key(protocol, stage):
+    if stage._key is None:
+        stage._key = (protocol.states_mask(stage.present),
+                      protocol.states_mask(stage.present_unique),
+                      protocol.states_mask(stage.absent),
+                      protocol.heads_mask(stage.disabled))
 
-# Unique key associated with stage_formula
-def stage_key(stage):
-    return (frozenset(stage.present),
-            frozenset(stage.present_unique),
-            frozenset(stage.absent),
-            frozenset(stage.disabled))
+    return stage._key
 
 # Formula Phi_C
 # Must remain consistent with info used in stage_key
@@ -145,64 +252,70 @@ def stage_formula(stage):
 
     return Phi
 
-def enlarge_stage_components(protocol, stage, valuation, K_):
-    def f(M, N, O):
-        def assert_rho(formula):
-            formula.assert_all_states_present(M)
-            formula.assert_all_states_present(N, unique=True)
-            formula.assert_all_states_absent(O)
-
-            return formula
+# Heads of the transitions that may make each state leave the present (M),
+# uniquely present (N) and absent (O) components of enlarge_stage_components.
+# They only depend on protocol, so they are computed once (in mem if given)
+def component_heads(protocol, mem=None):
+    if mem is not None and "heads" in mem:
+        return mem["heads"]
 
-        Phi = stage_formula(stage)
-        Phi.assert_all_pairs_absent(K_)
-        assert_rho(Phi)
+    M = {X: set() for X in protocol.states}
+    N = {X: set() for X in protocol.states}
+    O = {X: set() for X in protocol.states}
 
-        # Find elements to remove from M
-        remove_from_M = set()
+    for X in protocol.states:
+        for t in protocol.transitions:
+            # Case XY -> CD where C != X != D
+            if (X in t.pre) and (X not in t.post):
+                M[X].add(t.pre)
 
-        for X in M:
-            heads = set()
+            # Case XY -> CD where X != Y and [C = D = X or C != X != D]
+            if (X != t.pre.other(X)) and (t.postset == {X} or
+                                          X not in t.post):
+                N[X].add(t.pre)
+            # Case CD -> XY where C != X != D
+            elif (X in t.post) and (X not in t.pre):
+                N[X].add(t.pre)
 
-            for t in protocol.transitions:
-                # Case XY -> CD where C != X != D
-                if (X in t.pre) and (X not in t.post):
-                    heads.add(t.pre)
+            # Case CD -> XY where C != X != D
+            if (X in t.post) and (X not in t.pre):
+                O[X].add(t.pre)
 
-            if not Phi.implies_all_absent_tautology_check(heads):
-                remove_from_M.add(X)
+    heads = (M, N, O)
 
-        # Find elements to remove from N
-        remove_from_N = set()
+    if mem is not None:
+        mem["heads"] = heads
 
-        for X in N:
-            heads = set()
+    return heads
 
-            for t in protocol.transitions:
-                # Case XY -> CD where X != Y and [C = D = X or C != X != D]
-                if (X != t.pre.other(X)) and (t.postset == {X} or
-                                              X not in t.post):
-                    heads.add(t.pre)
-                # Case CD -> XY where C != X != D
-                elif (X in t.post) and (X not in t.pre):
-                    heads.add(t.pre)
+def enlarge_stage_components(protocol, stage, valuation, K_, heads=None):
+    heads_M, heads_N, heads_O = component_heads(protocol) if heads is None \
+                                else heads
 
-            if not Phi.implies_all_absent_tautology_check(heads):
-                remove_from_N.add(X)
+    def f(M, N, O):
+        def assert_rho(formula):
+            formula.assert_all_states_present(M)
+            formula.assert_all_states_present(N, unique=True)
+            formula.assert_all_states_absent(O)
 
-        # Find elements to remove from O
-        remove_from_O = set()
+            return formula
 
-        for X in O:
-            heads = set()
+        Phi = stage_formula(stage)
+        Phi.assert_all_pairs_absent(K_)
+        assert_rho(Phi)
 
-            for t in protocol.transitions:
-                # Case CD -> XY where C != X != D
-                if (X in t.post) and (X not in t.pre):
-                    heads.add(t.pre)
+        # Elements whose heads are not all absent are removed. All checks
+        # of the round are done on one solver
+        M_, N_, O_ = list(M), list(N), list(O)
+        absent     = Phi.implies_all_absent_tautology_checks(
+            [heads_M[X] for X in M_] +
+            [heads_N[X] for X in N_] +
+            [heads_O[X] for X in O_])
 
-            if not Phi.implies_all_absent_tautology_check(heads):
-                remove_from_O.add(X)
+        remove_from_M = {X for (X, a) in zip(M_, absent[:len(M_)]) if not a}
+        remove_from_N = {X for (X, a) in zip(N_, absent[len(M_):]) if not a}
+        remove_from_O = {X for (X, a) in zip(O_, absent[len(M_) + len(N_):])
+                         if not a}
 
         return (M - remove_from_M,
                 N - remove_from_N,
@@ -236,15 +349,11 @@ def compute_U(protocol, disabled, K_, refined):
             if ((t.pre not in disabled) and (t.post not in K_) and
                 ((not refined) or (not less_upair(t.pre, t.post))))}
 
-def compute_K_from_invariants(protocol, stage):
+def compute_K_from_invariants(protocol, stage, mem=None):
     T = set()
-    Phi = stage_formula(stage)
+    enabled = enabled_transitions(protocol, stage, mem)
 
-    trans = []
-    for t in protocol.transitions:
-        if ((not t.silent()) and
-            (not Phi.implies_all_absent_tautology_check({t.pre}))):
-            trans.append(t)
+    trans = [t for t in protocol.transitions if t in enabled]
 
     ctx = z3.Context()
     solver = z3.Solver(ctx=ctx)
@@ -270,7 +379,7 @@ def compute_K_from_invariants(protocol, stage):
     for idx,t in enumerate(trans):
         solver.push()
         solver.add(t_vars[idx] >= 1)
-        result = solver.check()
+        result = solver_stats.check(solver)
         solver.pop()
         if result == z3.sat:
             #print("Transition {} part of T-invariant".format(t))
@@ -292,7 +401,7 @@ def new_stages(protocol, stage, mem, use_t_invariants):
 
     if use_t_invariants:
         # Compute K and T from transition invariants
-        K, T = compute_K_from_invariants(protocol, stage)
+        K, T = compute_K_from_invariants(protocol, stage, mem)
     else:
         # Compute K from transformation graph
         K, T = compute_K(protocol, stage, mem)
@@ -329,15 +438,18 @@ def new_stages(protocol, stage, mem, use_t_invariants):
     Phi.assert_all_pairs_absent(K_)
     Phi.assert_formula(phi_)
 
-    stages = []
+    heads = component_heads(protocol, mem)
 
-    for val in Phi.solutions():
-        enlarged  = enlarge_stage_components(protocol, stage, val, K_)
-        disabled_ = stage.disabled | K_
+    # New stages are constructed lazily, as solutions are enumerated
+    def stages():
+        for val in Phi.solutions():
+            enlarged  = enlarge_stage_components(protocol, stage, val, K_,
+                                                 heads)
+            disabled_ = stage.disabled | K_
 
-        stages.append(Stage(*enlarged, disabled_, phi_, parent=stage))
+            yield Stage(*enlarged, disabled_, phi_, parent=stage)
 
-    return stages, refined
+    return stages(), refined
 
 def check_termination_witness(protocol, stage, refined):
     if refined:
@@ -384,8 +496,10 @@ def check_termination_witness(protocol, stage, refined):
             return None
 
 def is_good(protocol, stage, mem, use_t_invariants):
-    graph, vertices, edges   = transformation_graph(protocol, stage)
-    components, _, is_bottom = label_components(graph, attractors=True)
+    graph, vertices, edges = transformation_graph(protocol, stage, mem)
+    components             = graph.condensation()
+    scc                    = {q: components.component(vertices[q])
+                              for q in vertices}
 
     if use_t_invariants:
         # Compute K and T for comparison from transformation graph
@@ -399,15 +513,8 @@ def is_good(protocol, stage, mem, use_t_invariants):
         K_C = stage._K
         T_C = stage._T
 
-    A_C = {q for q in vertices if not is_bottom[components[vertices[q]]]}
-
-    # Checks if SCC i is a predecessor of SCC j
-    def pred_scc(i, j):
-        for (p, q) in edges:
-            if (components[vertices[p]] == i and components[vertices[q]] == j):
-                return True
-
-        return False
+    A_C = {q for q in vertices if not components.is_bottom(scc[q])}
+    pred_scc = components.is_predecessor
 
     # Checks if every AB -> CD in T_C generates an outgoing edge of A
     # in the transformation graph leading to an SCC different from the
@@ -417,9 +524,9 @@ def is_good(protocol, stage, mem, use_t_invariants):
             if t.pre == AB:
                 C = t.post.some()
                 D = t.post.other(C)
-                i = components[vertices[A]]
-                j = components[vertices[C]]
-                k = components[vertices[D]]
+                i = scc[A]
+                j = scc[C]
+                k = scc[D]
 
                 if not ((t in edges.get((A, C), set()) and pred_scc(i, j)) or
                         (t in edges.get((A, D), set()) and pred_scc(i, k))):
@@ -431,8 +538,7 @@ def is_good(protocol, stage, mem, use_t_invariants):
     for A in A_C:
         K_A = {head for head in K_C if ((A in head) and
                                         all_generate_edge(head, A))}
-        U_A = {B for B in A_C if pred_scc(components[vertices[B]],
-                                          components[vertices[A]])}
+        U_A = {B for B in A_C if pred_scc(scc[B], scc[A])}
 
         formula = stage_formula(stage)
         formula.assert_some_states_present({A})
@@ -7,6 +7,7 @@ class Transition:
         self._post    = upair(post)
         self._preset  = frozenset(self._pre)
         self._postset = frozenset(self._post)
+        self._hash    = hash((self._pre, self._post))
 
     @property
     def pre(self):
@@ -43,7 +44,12 @@ class Transition:
         return (self != other)
 
     def __hash__(self):
-        return hash((self._pre, self._post))
+        return self._hash
+
+    # Transitions are constructed again when unpickled, so that their hash
+    # is computed in the unpickling process
+    def __reduce__(self):
+        return (Transition, (tuple(self._pre), tuple(self._post)))
     
     def __str__(self):
         return "{} →  {}".format(str(self._pre), str(self._post))
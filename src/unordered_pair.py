@@ -9,6 +9,9 @@ class upair:
         else:
             self._x, self._y = tuple(x)
 
+        # Pairs are immutable, so their hash is only computed once
+        self._hash = hash(hash((self._x, self._y)) + hash((self._y, self._x)))
+
     def some(self):
         return self._x
 
@@ -44,7 +47,12 @@ class upair:
         yield self._y
 
     def __hash__(self):
-        return hash(hash((self._x, self._y)) + hash((self._y, self._x)))
+        return self._hash
+
+    # Pairs are constructed again when unpickled, as hashes (e.g. of
+    # strings) differ between processes
+    def __reduce__(self):
+        return (upair, (self._x, self._y))
     
     def __str__(self):
         return "⟅{}, {}⟆".format(self._x, self._y)
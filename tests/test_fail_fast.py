@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT, "src"))
+
+import cache
+from abstract import abstract_protocol, protocol_from_abstraction
+from stage_tree import StageTree
+
+def load_protocol(name):
+    with open(os.path.join(ROOT, "protocols", name)) as in_file:
+        return protocol_from_abstraction(abstract_protocol(json.load(in_file)))
+
+class FailFastTest(unittest.TestCase):
+    def setUp(self):
+        cache.QUERIES = None
+
+    # threshold_variant2 terminates, but some of its stages have no
+    # termination witness: fail-fast must not change the verdict
+    def test_verdict_without_witness(self):
+        protocol = load_protocol("threshold_variant2.ppp")
+        full     = StageTree(protocol, check_termination_witness=True)
+        fast     = StageTree(protocol, check_termination_witness=True,
+                             fail_fast=True)
+
+        self.assertTrue(len(full.failed_witness_stages) > 0)
+        self.assertIsNone(fast.failure())
+        self.assertEqual(len(fast.stages), len(full.stages))
+        self.assertEqual(fast.terminates(), full.terminates())
+        self.assertTrue(fast.terminates())
+        self.assertEqual(fast.witness(), full.witness())
+
+if __name__ == "__main__":
+    unittest.main()
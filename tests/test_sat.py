@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import random
+import sys
+import unittest
+
+import z3
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT, "src"))
+
+import cache
+import sat
+from abstract import abstract_protocol, protocol_from_abstraction
+from formula import Formula
+from stage_tree import StageTree
+
+ATOMS = ["a", "b", "c", "d", "e"]
+
+def to_z3(f):
+    if sat.is_atom(f):
+        return z3.Bool(f)
+    elif f[0] == "not":
+        return z3.Not(to_z3(f[1]))
+    elif f[0] == "and":
+        return z3.And([to_z3(g) for g in f[1]])
+    else:
+        return z3.Or([to_z3(g) for g in f[1]])
+
+def random_literal(rng, atoms):
+    atom = rng.choice(atoms)
+
+    return atom if rng.random() < 0.5 else sat.Not(atom)
+
+# Random conjunction of clauses (CNF), or disjunction of cubes (DNF)
+def random_normal_form(rng, atoms, dnf):
+    inner = sat.And if dnf else sat.Or
+    outer = sat.Or  if dnf else sat.And
+
+    return outer([inner([random_literal(rng, atoms)
+                         for _ in range(rng.randint(0, 3))])
+                  for _ in range(rng.randint(0, 4))])
+
+# Random nested formula, as encoded by the Tseitin transformation
+def random_formula(rng, atoms, depth):
+    if depth == 0 or rng.random() < 0.3:
+        return random_literal(rng, atoms)
+
+    op = rng.choice([sat.And, sat.Or, sat.Not])
+
+    if op is sat.Not:
+        return sat.Not(random_formula(rng, atoms, depth - 1))
+
+    return op([random_formula(rng, atoms, depth - 1)
+               for _ in range(rng.randint(0, 3))])
+
+def random_formulas(rng):
+    atoms = ATOMS[:rng.randint(1, len(ATOMS))]
+    kind  = rng.choice(["cnf", "dnf", "nested"])
+
+    if kind == "nested":
+        return [random_formula(rng, atoms, 3)
+                for _ in range(rng.randint(1, 3))]
+
+    return [random_normal_form(rng, atoms, kind == "dnf")
+            for _ in range(rng.randint(1, 3))]
+
+def random_stage_formula(rng, states, backend):
+    formula = Formula(backend=backend)
+    pairs   = [(p, q) for p in states for q in states if str(p) <= str(q)]
+
+    for _ in range(rng.randint(1, 4)):
+        method = rng.choice([formula.assert_some_states_present,
+                             formula.assert_all_states_absent,
+                             formula.assert_some_pair_present,
+                             formula.assert_all_pairs_absent])
+
+        if method in (formula.assert_some_states_present,
+                      formula.assert_all_states_absent):
+            method(set(rng.sample(states, rng.randint(1, len(states)))),
+                   rng.random() < 0.3)
+        else:
+            method(set(rng.sample(pairs, rng.randint(1, 3))))
+
+    return formula
+
+# Copy of formula solved by backend
+def with_backend(formula, backend):
+    other = Formula(backend=backend)
+    other.assert_formula(formula)
+
+    return other
+
+def tautology_checks(formula, other, pairs, states):
+    return [formula.implies_all_absent_tautology_check(pairs),
+            formula.implies_all_absent_tautology_checks([pairs, set()]),
+            formula.implies_some_present_tautology_check(pairs),
+            formula.implies_all_states_absent_tautology_check(states),
+            formula.implies(other)]
+
+class SolverTest(unittest.TestCase):
+    def assertAgrees(self, solver, z3_solver, formulas):
+        result = solver.check()
+
+        self.assertEqual(result == sat.SAT, z3_solver.check() == z3.sat,
+                         formulas)
+
+        if result == sat.SAT:
+            model = solver.model()
+            model = {atom: model.get(atom, False) for atom in ATOMS}
+
+            for f in formulas:
+                self.assertIs(sat.evaluate(f, model), True, formulas)
+
+    def test_check_and_model(self):
+        rng = random.Random(1)
+
+        for _ in range(2000):
+            formulas  = random_formulas(rng)
+            solver    = sat.Solver()
+            z3_solver = z3.Solver()
+
+            solver.add(*formulas)
+            z3_solver.add([to_z3(f) for f in formulas])
+
+            self.assertAgrees(solver, z3_solver, formulas)
+
+    def test_push_pop(self):
+        rng = random.Random(2)
+
+        for _ in range(1000):
+            base      = random_formulas(rng)
+            scoped    = random_formulas(rng)
+            solver    = sat.Solver()
+            z3_solver = z3.Solver()
+
+            solver.add(*base)
+            z3_solver.add([to_z3(f) for f in base])
+
+            solver.push()
+            z3_solver.push()
+            solver.add(*scoped)
+            z3_solver.add([to_z3(f) for f in scoped])
+            self.assertAgrees(solver, z3_solver, base + scoped)
+
+            solver.pop()
+            z3_solver.pop()
+            self.assertAgrees(solver, z3_solver, base)
+
+class FormulaBackendTest(unittest.TestCase):
+    def setUp(self):
+        cache.QUERIES = None
+
+    def assertBackendsAgree(self, formula, rng, states):
+        z3_formula     = with_backend(formula, "z3")
+        native_formula = with_backend(formula, "native")
+        pairs          = [(p, q) for p in states for q in states
+                          if str(p) <= str(q)]
+
+        for _ in range(5):
+            checked = set(rng.sample(pairs, rng.randint(1, 3)))
+            absent  = set(rng.sample(states, rng.randint(1, len(states))))
+
+            self.assertEqual(
+                tautology_checks(z3_formula, formula, checked, absent),
+                tautology_checks(native_formula, formula, checked, absent),
+                str(formula))
+
+        projections = [None, {v for v in formula.domain if not v.unique}]
+
+        for projection in projections:
+            self.assertEqual(set(z3_formula.solutions(projection)),
+                             set(native_formula.solutions(projection)),
+                             str(formula))
+
+    def test_random_stage_formulas(self):
+        rng    = random.Random(3)
+        states = ["p", "q", "r", "s"]
+
+        for _ in range(200):
+            formula = random_stage_formula(rng, states, "z3")
+            self.assertBackendsAgree(formula, rng, states)
+
+    def test_protocol_stage_formulas(self):
+        filename = os.path.join(ROOT, "protocols", "remainder_0.ppp")
+
+        with open(filename) as in_file:
+            abstraction = abstract_protocol(json.load(in_file))
+
+        protocol = protocol_from_abstraction(abstraction)
+
+        rng    = random.Random(4)
+        states = sorted(protocol.states, key=str)
+        tree   = StageTree(protocol, check_termination_witness=True)
+
+        for stage in tree.stages.values():
+            self.assertBackendsAgree(stage.formula, rng, states)
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        cache.QUERIES = None
+
+    # Queries on a formula while its solutions are being enumerated must
+    # not see the blocked solutions
+    def test_interleaved_queries(self):
+        for incremental in (False, True):
+            formula = Formula(incremental=incremental, backend="z3")
+            formula.assert_some_states_present({"p", "q", "r"})
+
+            solutions = formula.solutions()
+            first     = next(solutions)
+
+            self.assertFalse(formula.implies_all_states_absent_tautology_check(
+                {"p", "q", "r"}))
+            self.assertEqual(len(set(formula.solutions())), 7)
+            self.assertEqual(len({first} | set(solutions)), 7)
+
+if __name__ == "__main__":
+    unittest.main()